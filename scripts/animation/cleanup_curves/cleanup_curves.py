@@ -1,6 +1,8 @@
 '''
 Removes redundant keys on animation curves.
 
+Requires cleanup_curves_engine.py next to this script.
+
 For example, if the keyframes at time {1, 5, 9} have the same value, but at time {13} the value changes. The keyframe at time {5} will be removed.
 
 stepped=True
@@ -11,35 +13,202 @@ Will remove the last keyframe if it is identical the the previous keyframe.
 
 tolerance=0.001
 How large the difference needs to be for two keyframes to be considered equal. Setting the value to 0 may not produce expected results.
+
+maxError=0
+When larger than 0, sloped curves are simplified as well. Keys are removed as long as the curve stays within maxError
+of the original keys. The curve is evaluated at every removed key afterwards, and keys are added back where the
+tangents make it differ more than maxError. The first and last keys are kept and stepped, keepLast and tolerance are
+ignored. Useful for reducing baked or motion captured animation.
+
+scope='selection'
+Which curves to clean. 'selection' uses curves connected to the selected objects, 'character' uses curves connected to
+the selected character sets and 'scene' uses every animation curve in the scene. Each curve is only processed once,
+even when it drives several objects.
 '''
 
 import pymel.core as pm
+import maya.cmds as cmds
+import maya.api.OpenMaya as om
+import maya.api.OpenMayaAnim as oma
 import maya.mel
 
+from cleanup_curves_engine import redundantKeys, simplifyKeys, maskIndices
+
 
-def isclose(a, b, epsilon=1e-09):
+def keyRanges(times, indices):
     """
-    Compare two numbers for equality with supplied epsilon
-    :param a: First value
-    :param b: Second value
-    :param epsilon: Max. allowed difference
-    :return: True if difference between a and b is less than epsilon
+    Merge runs of consecutive key indices into time ranges
+    :param times: Key times of the curve, in key order
+    :param indices: Sorted indices of the keys
+    :return: List of (start, end) time tuples covering exactly the given keys
     """
-    return abs(a - b) < epsilon
+    ranges = []
+    start = None
+    
+    for n, i in enumerate(indices):
+        if start is None:
+            start = i
+        
+        if n + 1 == len(indices) or indices[n + 1] != i + 1:
+            ranges.append((times[start], times[i]))
+            start = None
+    
+    return ranges
 
 
-def cleanupCurves(stepped=False, keepLast=True, tolerance=0.001):
+def removeKeys(curve, times, indices, unitless=False):
+    """
+    Remove keys from a curve with a single cutKey call
+    :param curve: Animation curve
+    :param times: Key times of the curve, in key order
+    :param indices: Sorted indices of the keys to remove
+    :param unitless: Curve has unitless input, e.g. a driven key
+    :return: Number of keys removed
+    """
+    if not indices:
+        return 0
+    
+    if unitless:
+        cmds.cutKey(curve, float=keyRanges(times, indices), option='keys', clear=True)
+    else:
+        cmds.cutKey(curve, time=keyRanges(times, indices), option='keys', clear=True)
+    return len(indices)
+
+
+def evaluateCurve(fn, time):
+    """
+    Evaluate a curve in the same units as readKeys
+    :param fn: MFnAnimCurve
+    :param time: Time in ui units, or input value for unitless curves
+    :return: Value in ui units
+    """
+    if fn.isUnitlessInput:
+        value = fn.evaluate(time)
+    else:
+        value = fn.evaluate(om.MTime(time, om.MTime.uiUnit()))
+    
+    curveType = fn.animCurveType
+    if curveType in (oma.MFnAnimCurve.kAnimCurveTA, oma.MFnAnimCurve.kAnimCurveUA):
+        return om.MAngle(value).asUnits(om.MAngle.uiUnit())
+    elif curveType in (oma.MFnAnimCurve.kAnimCurveTL, oma.MFnAnimCurve.kAnimCurveUL):
+        return om.MDistance(value).asUnits(om.MDistance.uiUnit())
+    
+    return value
+
+
+def restoreKeys(fn, times, values, indices, maxError):
+    """
+    Add back removed keys where the curve differs more than maxError from the original keys.
+    The straight lines used by simplifyKeys are only exact for linear tangents, and every added key changes the
+    tangents of its neighbours, so the removed keys are checked again until none of them is off.
+    :param fn: MFnAnimCurve
+    :param times: Key times before removing keys
+    :param values: Key values before removing keys
+    :param indices: Indices of the removed keys
+    :return: Number of keys added back
+    """
+    curve = fn.name()
+    removed = list(indices)
+    added = 0
+    
+    while removed:
+        off = [i for i in removed if abs(evaluateCurve(fn, times[i]) - values[i]) > maxError]
+        if not off:
+            break
+        
+        for i in off:
+            if fn.isUnitlessInput:
+                cmds.setKeyframe(curve, float=times[i], value=values[i])
+            else:
+                cmds.setKeyframe(curve, time=times[i], value=values[i])
+        
+        added += len(off)
+        off = set(off)
+        removed = [i for i in removed if i not in off]
+    
+    return added
+
+
+def listCurves(scope='selection'):
+    """
+    Gather animation curves, each curve only once
+    :param scope: 'selection', 'character' or 'scene'
+    :return: List of MFnAnimCurve
+    """
+    if scope == 'scene':
+        curves = []
+        it = om.MItDependencyNodes(om.MFn.kAnimCurve)
+        while not it.isDone():
+            curves.append(oma.MFnAnimCurve(it.thisNode()))
+            it.next()
+        return curves
+    
+    if scope == 'character':
+        nodes = cmds.ls(sl=True, type='character')
+    else:
+        nodes = cmds.ls(sl=True)
+    
+    if not nodes:
+        return []
+    
+    # one query for all nodes, then remove curves shared by several nodes
+    names = []
+    seen = set()
+    for name in cmds.listConnections(nodes, type='animCurve') or []:
+        if name not in seen:
+            seen.add(name)
+            names.append(name)
+    
+    selection = om.MSelectionList()
+    for name in names:
+        selection.add(name)
+    
+    return [oma.MFnAnimCurve(selection.getDependNode(i)) for i in range(selection.length())]
+
+
+def readKeys(fn):
+    """
+    Read all keys of a curve through the API
+    :param fn: MFnAnimCurve
+    :return: Tuple of (times, values) in UI units
+    """
+    count = fn.numKeys
+    
+    if fn.isUnitlessInput:
+        times = [fn.unitlessInput(i) for i in range(count)]
+    else:
+        unit = om.MTime.uiUnit()
+        times = [fn.input(i).asUnits(unit) for i in range(count)]
+    
+    values = [fn.value(i) for i in range(count)]
+    
+    # the api uses internal units, convert to what the graph editor shows
+    curveType = fn.animCurveType
+    if curveType in (oma.MFnAnimCurve.kAnimCurveTA, oma.MFnAnimCurve.kAnimCurveUA):
+        unit = om.MAngle.uiUnit()
+        values = [om.MAngle(v).asUnits(unit) for v in values]
+    elif curveType in (oma.MFnAnimCurve.kAnimCurveTL, oma.MFnAnimCurve.kAnimCurveUL):
+        unit = om.MDistance.uiUnit()
+        values = [om.MDistance(v).asUnits(unit) for v in values]
+    
+    return times, values
+
+
+def cleanupCurves(stepped=False, keepLast=True, tolerance=0.001, maxError=0.0, scope='selection'):
     """
     Remove redundant keys on animation curves.
     :param stepped: Applied on stepped curves.
     :param keepLast: Always keep the last keyframe.
     :param tolerance: Max. allowed difference before key is removed.
+    :param maxError: Simplify sloped curves within this error bound. Disabled when 0.
+    :param scope: Curves of 'selection', 'character' or 'scene'.
     :return: Total number of keys removed.
     """
     
     # return value
     totalKeys = 0
-    selection = pm.ls(sl=True)
+    curves = listCurves(scope)
+    stats = []
     
     gMainProgressBar = maya.mel.eval('$tmp = $gMainProgressBar')
     pm.progressBar(gMainProgressBar,
@@ -47,45 +216,41 @@ def cleanupCurves(stepped=False, keepLast=True, tolerance=0.001):
                    beginProgress=True,
                    isInterruptable=True,
                    status='Cleaning curves...',
-                   maxValue=len(selection))
+                   maxValue=max(len(curves), 1))
     
-    for obj in selection:
-        curves = pm.listConnections(obj, type="animCurve")
-        
-        for curve in curves:
-            keys = pm.keyframe(curve, q=True, timeChange=True, valueChange=True)
-            
-            toRemove = []
-            count = len(keys)
-            
-            for i, (time, value) in enumerate(keys):
-                if i < count - 2:
-                    nextValue = keys[i + 1][1]
-                    
-                    if stepped and isclose(value, nextValue, tolerance):
-                        toRemove.append(keys[i + 1][0])
-                    elif isclose(value, nextValue, tolerance) \
-                            and isclose(nextValue, keys[i + 2][1], tolerance):
-                        toRemove.append(keys[i + 1][0])
+    # one undo step for the whole run
+    with pm.UndoChunk():
+        for fn in curves:
+            times, values = readKeys(fn)
             
-            if not keepLast and count > 1:
-                if isclose(keys[count - 1][1], keys[count - 2][1], tolerance):
-                    toRemove.append(keys[count - 1][0])
-            
-            if toRemove:
-                for t in toRemove:
-                    pm.cutKey(curve, time=t)
-                    totalKeys += 1
+            if times:
+                if maxError > 0:
+                    mask = simplifyKeys(times, values, maxError)
+                else:
+                    mask = redundantKeys(values, stepped, keepLast, tolerance)
+                
+                toRemove = maskIndices(mask)
+                
+                # remove all redundant keys of the curve at once
+                removed = removeKeys(fn.name(), times, toRemove, fn.isUnitlessInput)
+                if removed and maxError > 0:
+                    removed -= restoreKeys(fn, times, values, toRemove, maxError)
+                totalKeys += removed
+                
+                if removed:
+                    stats.append((fn.name(), len(times), removed))
             
             # progress bar step
+            pm.progressBar(gMainProgressBar, edit=True, step=1)
             if pm.progressBar(gMainProgressBar, query=True, isCancelled=True):
                 break
-        
-        pm.progressBar(gMainProgressBar, edit=True, step=1)
     
     pm.progressBar(gMainProgressBar, edit=True, endProgress=True)
     
-    print "// {0} keys removed on ".format(totalKeys) + str([obj.name().encode() for obj in selection])
+    for name, count, removed in stats:
+        print("// {0}: {1} of {2} keys removed".format(name, removed, count))
+    
+    print("// {0} keys removed on {1} of {2} curves".format(totalKeys, len(stats), len(curves)))
     return int(totalKeys)
 
 
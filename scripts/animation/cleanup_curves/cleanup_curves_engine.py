@@ -0,0 +1,146 @@
+'''
+Key reduction rules used by cleanup_curves.
+
+Works on plain time/value sequences and does not depend on Maya, so it can be used and tested outside of Maya.
+NumPy is used when available, otherwise the rules fall back to pure Python.
+'''
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def isclose(a, b, epsilon=1e-09):
+    """
+    Compare two numbers for equality with supplied epsilon
+    :param a: First value
+    :param b: Second value
+    :param epsilon: Max. allowed difference
+    :return: True if difference between a and b is less than epsilon
+    """
+    return abs(a - b) < epsilon
+
+
+def redundantKeys(values, stepped=False, keepLast=True, tolerance=0.001):
+    """
+    Find keys that can be removed without changing the curve.
+    :param values: Key values, in key order.
+    :param stepped: Applied on stepped curves.
+    :param keepLast: Always keep the last keyframe.
+    :param tolerance: Max. allowed difference before key is removed.
+    :return: Removal mask with one boolean per key.
+    """
+    if np is None:
+        return _redundantKeysPython(values, stepped, keepLast, tolerance)
+
+    values = np.asarray(values, dtype=float)
+    count = len(values)
+    mask = np.zeros(count, dtype=bool)
+
+    if count < 2:
+        return mask
+
+    # same[i] is True when key i and key i + 1 have the same value
+    same = np.abs(np.diff(values)) < tolerance
+
+    if stepped:
+        mask[1:-1] = same[:-1]
+    else:
+        mask[1:-1] = same[:-1] & same[1:]
+
+    if not keepLast:
+        mask[-1] = same[-1]
+
+    return mask
+
+
+def _redundantKeysPython(values, stepped, keepLast, tolerance):
+    count = len(values)
+    mask = [False] * count
+
+    for i in range(count - 2):
+        if isclose(values[i], values[i + 1], tolerance):
+            if stepped or isclose(values[i + 1], values[i + 2], tolerance):
+                mask[i + 1] = True
+
+    if not keepLast and count > 1:
+        mask[-1] = isclose(values[-1], values[-2], tolerance)
+
+    return mask
+
+
+def maskIndices(mask):
+    """
+    Convert a removal mask to key indices
+    :param mask: Removal mask with one boolean per key
+    :return: Sorted list of indices where mask is True
+    """
+    if np is not None:
+        return np.flatnonzero(mask).tolist()
+    return [i for i, remove in enumerate(mask) if remove]
+
+
+def simplifyKeys(times, values, maxError=0.01):
+    """
+    Find keys that can be removed while the curve stays within an error bound.
+    Uses Ramer-Douglas-Peucker on the keys, measuring the value difference to a straight line between the kept keys.
+    The bound only holds for linear interpolation. With spline or auto tangents the curve can be further off, so
+    evaluate the simplified curve and add back keys where needed, like cleanup_curves does.
+    The first and last keys are always kept.
+    :param times: Key times, in key order.
+    :param values: Key values, in key order.
+    :param maxError: Max. allowed value difference between the original keys and the straight lines between kept keys.
+    :return: Removal mask with one boolean per key.
+    """
+    count = len(values)
+    
+    if np is None:
+        keep = [False] * count
+    else:
+        times = np.asarray(times, dtype=float)
+        values = np.asarray(values, dtype=float)
+        keep = np.zeros(count, dtype=bool)
+    
+    if count == 0:
+        return keep
+    
+    keep[0] = keep[-1] = True
+    
+    # iterative, so dense curves do not hit the recursion limit
+    segments = [(0, count - 1)]
+    while segments:
+        first, last = segments.pop()
+        if last - first < 2:
+            continue
+        
+        index, error = _maxSegmentError(times, values, first, last)
+        if error > maxError:
+            keep[index] = True
+            segments.append((first, index))
+            segments.append((index, last))
+    
+    if np is None:
+        return [not k for k in keep]
+    return ~keep
+
+
+def _maxSegmentError(times, values, first, last):
+    """
+    Find the key between first and last that is furthest away from the line connecting them
+    :return: Tuple of (index, error)
+    """
+    t0, v0 = times[first], values[first]
+    slope = (values[last] - v0) / float(times[last] - t0)
+    
+    if np is not None:
+        errors = np.abs(values[first + 1:last] - (v0 + slope * (times[first + 1:last] - t0)))
+        i = int(np.argmax(errors))
+        return first + 1 + i, errors[i]
+    
+    index, error = first + 1, -1.0
+    for i in range(first + 1, last):
+        e = abs(values[i] - (v0 + slope * (times[i] - t0)))
+        if e > error:
+            index, error = i, e
+    return index, error
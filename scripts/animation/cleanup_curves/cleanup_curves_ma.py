@@ -0,0 +1,278 @@
+'''
+Removes redundant keys on animation curves in Maya ASCII files, without Maya.
+
+Uses the same rules as cleanup_curves and requires cleanup_curves_engine.py next to this script.
+Only time based curves (animCurveTL, animCurveTA, animCurveTU and animCurveTT) are cleaned. Values are compared in the
+units stored in the file, e.g. degrees for rotation. Files are rewritten in place in a single pass and several files
+are processed in parallel.
+
+--max-error is measured against straight lines between the kept keys, since the curves are not evaluated here. It is
+only an exact bound for curves with linear tangents.
+
+Usage:
+python cleanup_curves_ma.py [--stepped] [--remove-last] [--tolerance 0.001] [--max-error 0] [--jobs N] file.ma ...
+'''
+
+import argparse
+import io
+import multiprocessing
+import os
+import re
+import sys
+
+from cleanup_curves_engine import redundantKeys, simplifyKeys, maskIndices
+
+CURVE_NODE = re.compile(r'createNode animCurveT[LATU]\b')
+
+# setAttr on a per-key array attribute, e.g. setAttr -s 3 ".ktv[0:2]"  1 0 10 5 20 0;
+KEY_ATTR = re.compile(r'^(\s*)setAttr((?:\s+-\w+\s+[^\s"]+)*)\s+"\.(k\w*)\[(\d+)(?::(\d+))?\]"(.*);\s*$', re.S)
+FLAG = re.compile(r'-(\w+)\s+([^\s"]+)')
+
+# number of values per line when writing key arrays
+VALUES_PER_LINE = 20
+
+
+def splitStatements(lines):
+    """
+    Group the lines of a node block into MEL statements
+    :param lines: Lines following a createNode line
+    :return: List of statements, each statement is a list of lines
+    """
+    statements = []
+    current = []
+
+    for line in lines:
+        current.append(line)
+        if line.rstrip().endswith(';'):
+            statements.append(current)
+            current = []
+
+    if current:
+        statements.append(current)
+
+    return statements
+
+
+def parseKeyAttr(statement):
+    """
+    Parse a setAttr statement on a per-key array attribute
+    :param statement: Statement text
+    :return: Tuple of (indent, flags, attr, {index: tokens}) or None if it is not a per-key attribute
+    """
+    match = KEY_ATTR.match(statement)
+    if match is None:
+        return None
+
+    indent, flags, attr, start, end, data = match.groups()
+    start = int(start)
+    end = int(end) if end is not None else start
+    tokens = data.split()
+    size = end - start + 1
+
+    if size < 1 or len(tokens) % size:
+        return None
+
+    width = len(tokens) // size
+    entries = dict((start + i, tokens[i * width:(i + 1) * width]) for i in range(size))
+
+    return indent, FLAG.findall(flags), attr, entries
+
+
+def formatKeyAttr(indent, flags, attr, entries, size, newline):
+    """
+    Write per-key array entries as setAttr statements, one per run of consecutive indices
+    :param size: Number of keys on the curve, written as -s. Arrays like .kit may only have entries for some keys
+    :return: List of lines
+    """
+    indices = sorted(entries)
+    lines = []
+
+    runs = []
+    for i in indices:
+        if runs and runs[-1][-1] == i - 1:
+            runs[-1].append(i)
+        else:
+            runs.append([i])
+
+    for n, run in enumerate(runs):
+        flagText = ''
+        for flag, value in flags:
+            if flag == 's':
+                if n == 0:
+                    flagText += ' -s %d' % size
+            else:
+                flagText += ' -%s %s' % (flag, value)
+
+        if len(run) == 1:
+            spec = '%d' % run[0]
+        else:
+            spec = '%d:%d' % (run[0], run[-1])
+
+        tokens = []
+        for i in run:
+            tokens.extend(entries[i])
+
+        chunks = [' '.join(tokens[j:j + VALUES_PER_LINE]) for j in range(0, len(tokens), VALUES_PER_LINE)]
+        text = '%ssetAttr%s ".%s[%s]"  %s;' % (indent, flagText, attr, spec, (newline + '\t\t').join(chunks))
+        lines.append(text + newline)
+
+    return lines
+
+
+def cleanupBlock(lines, stepped=False, keepLast=True, tolerance=0.001, maxError=0.0):
+    """
+    Remove redundant keys from the statements of one animation curve node
+    :param lines: Lines following the createNode line
+    :return: Tuple of (lines, number of keys, number of keys removed)
+    """
+    statements = splitStatements(lines)
+    keyAttrs = {}
+    parsed = []
+
+    for statement in statements:
+        result = parseKeyAttr(''.join(statement))
+        parsed.append(result)
+
+        if result is not None:
+            indent, flags, attr, entries = result
+            if attr not in keyAttrs:
+                keyAttrs[attr] = (indent, flags, {})
+            keyAttrs[attr][2].update(entries)
+
+    keys = keyAttrs.get('ktv', (None, None, {}))[2]
+    count = len(keys)
+
+    # leave curves alone if the keys are not stored the way we expect
+    if count == 0 or sorted(keys) != list(range(count)) or any(len(keys[i]) != 2 for i in keys):
+        return lines, count, 0
+
+    try:
+        times = [float(keys[i][0]) for i in range(count)]
+        values = [float(keys[i][1]) for i in range(count)]
+    except ValueError:
+        return lines, count, 0
+
+    if maxError > 0:
+        mask = simplifyKeys(times, values, maxError)
+    else:
+        mask = redundantKeys(values, stepped, keepLast, tolerance)
+
+    toRemove = set(maskIndices(mask))
+    if not toRemove:
+        return lines, count, 0
+
+    # map old key index to new key index
+    newIndex = {}
+    for i in range(count):
+        if i not in toRemove:
+            newIndex[i] = len(newIndex)
+
+    newline = '\r\n' if lines[0].endswith('\r\n') else '\n'
+    result = []
+    written = set()
+
+    for statement, key in zip(statements, parsed):
+        if key is None:
+            result.extend(statement)
+            continue
+
+        attr = key[2]
+        if attr in written:
+            continue
+        written.add(attr)
+
+        indent, flags, entries = keyAttrs[attr]
+        kept = dict((newIndex[i], tokens) for i, tokens in entries.items() if i in newIndex)
+        if kept:
+            result.extend(formatKeyAttr(indent, flags, attr, kept, len(newIndex), newline))
+
+    return result, count, len(toRemove)
+
+
+def cleanupFile(path, stepped=False, keepLast=True, tolerance=0.001, maxError=0.0):
+    """
+    Remove redundant keys in a Maya ASCII file, writing the file back in place
+    :param path: Path to .ma file
+    :return: Tuple of (path, number of curves, number of keys, number of keys removed)
+    """
+    tmpPath = path + '.tmp'
+    curves = 0
+    totalKeys = 0
+    totalRemoved = 0
+
+    # latin-1 reads any byte, so everything outside the curves is written back unchanged
+    with io.open(path, 'r', encoding='latin-1', newline='') as src, \
+            io.open(tmpPath, 'w', encoding='latin-1', newline='') as dst:
+        block = None
+
+        for line in src:
+            if block is not None:
+                if line[:1] in ('\t', ' '):
+                    block.append(line)
+                    continue
+
+                lines, count, removed = cleanupBlock(block, stepped, keepLast, tolerance, maxError)
+                dst.writelines(lines)
+                curves += 1
+                totalKeys += count
+                totalRemoved += removed
+                block = None
+
+            dst.write(line)
+            if CURVE_NODE.match(line):
+                block = []
+
+        if block:
+            lines, count, removed = cleanupBlock(block, stepped, keepLast, tolerance, maxError)
+            dst.writelines(lines)
+            curves += 1
+            totalKeys += count
+            totalRemoved += removed
+
+    if totalRemoved:
+        getattr(os, 'replace', os.rename)(tmpPath, path)
+    else:
+        os.remove(tmpPath)
+
+    return path, curves, totalKeys, totalRemoved
+
+
+def _cleanupFileJob(args):
+    path, options = args
+    try:
+        return cleanupFile(path, **options)
+    except (IOError, OSError) as e:
+        sys.stderr.write('# Could not clean %s: %s\n' % (path, e))
+        return path, 0, 0, 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Remove redundant keys on animation curves in Maya ASCII files.')
+    parser.add_argument('files', nargs='+', help='Maya ASCII files to clean in place')
+    parser.add_argument('--stepped', action='store_true', help='Applied on stepped curves')
+    parser.add_argument('--remove-last', action='store_true', help='Remove the last key if identical to the previous')
+    parser.add_argument('--tolerance', type=float, default=0.001, help='Max. allowed difference before key is removed')
+    parser.add_argument('--max-error', type=float, default=0.0, help='Simplify sloped curves within this error bound')
+    parser.add_argument('--jobs', type=int, default=0, help='Number of processes, defaults to number of cpus')
+    args = parser.parse_args(argv)
+
+    options = dict(stepped=args.stepped, keepLast=not args.remove_last, tolerance=args.tolerance,
+                   maxError=args.max_error)
+    jobs = [(path, options) for path in args.files]
+
+    pool = multiprocessing.Pool(args.jobs or None)
+    try:
+        totalRemoved = 0
+        for path, curves, keys, removed in pool.imap_unordered(_cleanupFileJob, jobs):
+            totalRemoved += removed
+            sys.stdout.write('// %s: %d of %d keys removed on %d curves\n' % (path, removed, keys, curves))
+    finally:
+        pool.close()
+        pool.join()
+
+    sys.stdout.write('// %d keys removed in %d files\n' % (totalRemoved, len(jobs)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
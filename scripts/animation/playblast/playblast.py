@@ -1,22 +1,302 @@
 '''
 Playblast using filename and H.264 compression
+
+encoder=None
+Playblast directly to a QuickTime H.264 movie with Maya. Blocks Maya until the movie is written.
+
+encoder='ffmpeg'
+Playblast an image sequence to a temporary folder and encode it with ffmpeg in the background, using the ffmpeg
+preset, e.g. custom_playblast(encoder='ffmpeg', preset='h264_draft'). Maya can be used again as soon as the images are
+written, and a message is shown when the movie is done. ffmpeg must be on the path, or set the FFMPEG environment
+variable to the ffmpeg executable.
+
+encoder='incremental'
+Like 'ffmpeg', but rendered frames are kept in a cache next to the movie and only frames that changed are rendered
+again. A frame is considered changed when the camera, or the transform, bounding box or visibility of any geometry is
+different, or when the display settings of the viewport (shaded, wireframe, textures, lighting, shown object types) or
+fast=True changed. Changes to materials, lights or deformations that do not change the bounding box are not detected, use
+clear_frame_cache() after such changes.
+
+encoder='chunked'
+Split the frame range into chunks, playblast each chunk in its own Maya session at the same time, and encode the frames
+of all chunks and the sound with ffmpeg. Uses the saved scene, or a temporary copy of it when there are unsaved changes.
+Maya can be used while the chunks are rendering. The Maya sessions are started like in batch playblast below.
+
+fast=True
+Use the settings in FAST_PROFILE while playblasting: parallel evaluation with cached playback, no smooth mesh preview,
+only geometry shown in the viewport, and display layers and deformers with a "playblastNonEssential" attribute turned
+on are hidden or disabled. Every setting is restored afterwards, also when the playblast fails. The frames per second
+are printed when done.
+
+Batch playblast
+Playblast many shots in parallel Maya processes, without any user interaction, either from Maya:
+
+import playblast
+playblast.batch_playblast(jobs, processes=4)
+
+or from a shell, with the jobs saved as a JSON file:
+
+mayapy playblast.py jobs.json --processes 4
+
+Each job is a dictionary with the scene to playblast, and optionally "camera" (defaults to persp), "start" and "end"
+(defaults to the playback range), "filename" (defaults to the same name as custom_playblast would suggest), "movie_dir"
+(defaults to the movie folder of the project the scene is in), "encoder" ('ffmpeg' or 'incremental'), "preset" and
+"fast", e.g.
+{"scene": "/project/scenes/sh_0010_ANI_0012.ma", "camera": "shotCam", "start": 1001, "end": 1096}
+
+Playblasting needs a viewport, so each job runs in a Maya session started with -command, not in mayapy. On Linux without
+a display, the sessions are started offscreen with xvfb-run. Movies are always encoded with ffmpeg and the scenes are
+never saved.
 '''
 
 import maya.mel
+import maya.utils
+import maya.cmds as cmds
 import pymel.core as pm
 import maya.OpenMaya as OpenMaya
 import maya.OpenMayaUI as OpenMayaUI
+import maya.api.OpenMaya as om
+import argparse
+import contextlib
+import hashlib
+import json
+import multiprocessing
+import platform
 import re
 import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import webbrowser
+from multiprocessing.pool import ThreadPool
+
+# ffmpeg video options for each preset, lower crf is better quality
+FFMPEG_PRESETS = {
+    'h264': ['-c:v', 'libx264', '-preset', 'medium', '-crf', '18', '-pix_fmt', 'yuv420p'],
+    'h264_draft': ['-c:v', 'libx264', '-preset', 'veryfast', '-crf', '28', '-pix_fmt', 'yuv420p'],
+    'prores': ['-c:v', 'prores_ks', '-profile:v', '2', '-pix_fmt', 'yuv422p10le'],
+}
+
+# image format of the playblast before encoding, fast to write and read
+IMAGE_FORMAT = 'tif'
+
+# settings changed by fast=True while playblasting, everything is restored afterwards
+FAST_PROFILE = {
+    'evaluation': 'parallel',  # evaluation manager mode
+    'cached_playback': True,
+    'smooth_mesh_preview': False,
+    'hide_types': ['nurbsCurves', 'joints', 'locators', 'ikHandles', 'deformers', 'dynamics', 'lights', 'cameras',
+                   'grid', 'handles', 'dimensions', 'pivots', 'motionTrails', 'manipulators'],
+    # display layers with this attribute turned on are hidden, other nodes are disabled, e.g. heavy deformers
+    'non_essential_attribute': 'playblastNonEssential',
+}
 
+# folder next to the movies with the frames of incremental playblasts, bump the version to invalidate all frames
+CACHE_DIR = '.playblast_cache'
+CACHE_VERSION = 1
 
-def custom_playblast():
+# model editor settings that change the image, part of the hash of each cached frame
+EDITOR_FLAGS = ['displayAppearance', 'displayTextures', 'displayLights', 'wireframeOnShaded', 'shadows',
+                'useDefaultMaterial', 'xray', 'jointXray', 'backfaceCulling', 'twoSidedLighting', 'smoothWireframe',
+                'polymeshes', 'nurbsSurfaces', 'subdivSurfaces', 'planes', 'imagePlane', 'fluids', 'hairSystems',
+                'follicles', 'nCloths', 'nParticles', 'strokes', 'textures']
+
+# camera shape attributes that change the image, besides the camera matrix
+CAMERA_ATTRIBUTES = ['focalLength', 'orthographicWidth', 'horizontalFilmAperture', 'verticalFilmAperture',
+                     'horizontalFilmOffset', 'verticalFilmOffset', 'nearClipPlane', 'farClipPlane']
+
+
+def custom_playblast(encoder=None, preset='h264', fast=False):
     # default paths
-    filename = os.path.splitext(os.path.basename(pm.system.sceneName()))[0]
-    movieDir = pm.workspace.fileRules['movie'] + "/"
-    movieDir.replace('\\', '/')
+    movieDir = get_movie_dir()
     
     # get camera name
+    camName, camShapeName = get_active_camera()
+    
+    # get render resolution
+    resolution = get_resolution()
+    
+    # prompt for postfix
+    message = "Camera: %s\n\nResolution: %dx%d\n\nFilename:" % (camName, resolution[0], resolution[1])
+    
+    filename = get_playblast_filename()
+    
+    result = pm.promptDialog(title="Playblast", message=message, button=["Playblast", "Cancel"],
+                             defaultButton="Playblast", cancelButton="Cancel", dismissString="Cancel", text=filename)
+    
+    if result == "Playblast":
+        newName = pm.promptDialog(q=True, text=True)
+        
+        if newName is not "":
+            filename = newName
+        
+        pm.system.fileInfo['playblastFilename'] = filename
+        
+        # assemble full path and filename
+        filename = movieDir + filename + ".mov"
+        
+        playblast_camera(filename, camShapeName, resolution, get_sound(), encoder, preset, fast=fast)
+
+
+def playblast_camera(filename, camShapeName, resolution, sound=None, encoder=None, preset='h264', start=None,
+                     end=None, background=True, viewer=True, fast=False):
+    """
+    Playblast through a camera with the resolution gate, restoring the camera afterwards.
+    :param filename: Movie file
+    :param camShapeName: Camera shape, should be the camera of the active view
+    :param resolution: [width, height]
+    :param sound: Sound node to add to the movie
+    :param encoder: None to playblast to QuickTime H.264, 'ffmpeg', 'incremental', 'chunked' or 'images' to only
+                    write an image sequence named filename.####.tif
+    :param preset: Name of the video options in FFMPEG_PRESETS
+    :param start: First frame, defaults to the start of the playback range
+    :param end: Last frame, defaults to the end of the playback range
+    :param background: Encode with ffmpeg in a background thread
+    :param viewer: Open the movie when it is done
+    :param fast: Use the settings in FAST_PROFILE while playblasting
+    :return: True if the movie is written, or is being encoded in the background
+    """
+    if start is None:
+        start = int(pm.playbackOptions(q=True, minTime=True))
+    if end is None:
+        end = int(pm.playbackOptions(q=True, maxTime=True))
+    
+    if encoder == 'chunked':
+        # the settings are changed in each of the Maya sessions instead
+        return chunked_playblast(filename, camShapeName, resolution, sound, preset, start, end, background, viewer,
+                                 fast=fast)
+    
+    # disable resolution gate
+    resGateEnabled = pm.getAttr(camShapeName + ".displayResolution")
+    overscan = pm.getAttr(camShapeName + ".overscan")
+    pm.setAttr(camShapeName + ".displayResolution", 1)
+    pm.setAttr(camShapeName + ".overscan", 1)
+    
+    # playblast!
+    try:
+        with playblast_profile(FAST_PROFILE if fast else None):
+            startTime = time.time()
+            
+            if encoder == 'ffmpeg':
+                result = ffmpeg_playblast(filename, resolution, sound, preset, start, end, background, viewer)
+            elif encoder == 'incremental':
+                result = incremental_playblast(filename, camShapeName, resolution, sound, preset, start, end,
+                                               background, viewer, FAST_PROFILE if fast else None)
+            elif encoder == 'images':
+                pm.animation.playblast(filename=filename, format='image', compression=IMAGE_FORMAT, framePadding=4,
+                                       startTime=start, endTime=end, forceOverwrite=True, sequenceTime=False,
+                                       clearCache=True, showOrnaments=False, offScreen=True, viewer=False,
+                                       percent=100, quality=100, widthHeight=resolution)
+                result = True
+            else:
+                pm.animation.playblast(filename=filename, format="qt", compression="H.264", forceOverwrite=True,
+                                       sequenceTime=False, clearCache=True, showOrnaments=False, offScreen=True,
+                                       viewer=viewer, percent=100, quality=100, widthHeight=resolution, sound=sound,
+                                       startTime=start, endTime=end)
+                result = True
+            
+            seconds = time.time() - startTime
+            sys.stdout.write('# Playblasted %d frames in %.1f s, %.1f fps\n' % (end - start + 1, seconds,
+                                                                             (end - start + 1) / max(seconds, 0.001)))
+            return result
+    finally:
+        # restore gate
+        pm.setAttr(camShapeName + ".displayResolution", resGateEnabled)
+        pm.setAttr(camShapeName + ".overscan", overscan)
+
+
+@contextlib.contextmanager
+def playblast_profile(profile=None, editor=None):
+    """
+    Temporarily change evaluation and display settings while playblasting. Every setting is restored afterwards, also
+    on errors.
+    :param profile: Dictionary like FAST_PROFILE, None to change nothing
+    :param editor: Model editor to change, defaults to the one the playblast uses
+    """
+    restore = []  # (function, args, kwargs) restoring each setting
+    try:
+        if profile:
+            apply_playblast_profile(profile, editor or cmds.playblast(activeEditor=True), restore)
+        yield
+    finally:
+        for function, args, kwargs in reversed(restore):
+            try:
+                function(*args, **kwargs)
+            except RuntimeError as e:
+                sys.stdout.write('# Could not restore playblast setting: %s\n' % e)
+
+
+def apply_playblast_profile(profile, editor, restore):
+    mode = profile.get('evaluation')
+    if mode:
+        current = cmds.evaluationManager(q=True, mode=True)[0]
+        if current != mode:
+            cmds.evaluationManager(mode=mode)
+            restore.append((cmds.evaluationManager, [], {'mode': current}))
+    
+    if profile.get('cached_playback') is not None:
+        try:
+            current = cmds.evaluator(name='cache', q=True, enable=True)
+            current = bool(current[0] if isinstance(current, list) else current)
+            if current != profile['cached_playback']:
+                cmds.evaluator(name='cache', enable=profile['cached_playback'])
+                restore.append((cmds.evaluator, [], {'name': 'cache', 'enable': current}))
+        except RuntimeError:
+            pass  # no cached playback before Maya 2019
+    
+    if profile.get('smooth_mesh_preview') is False:
+        for mesh in cmds.ls(type='mesh', noIntermediate=True, long=True):
+            set_attr_temporarily(mesh + '.displaySmoothMesh', 0, restore)
+    
+    attr = profile.get('non_essential_attribute')
+    if attr:
+        for node in cmds.ls('*.' + attr, recursive=True, objectsOnly=True, long=True) or []:
+            if not cmds.getAttr('%s.%s' % (node, attr)):
+                continue
+            
+            if cmds.nodeType(node) == 'displayLayer':
+                set_attr_temporarily(node + '.visibility', 0, restore)
+            elif cmds.attributeQuery('envelope', node=node, exists=True):
+                set_attr_temporarily(node + '.envelope', 0, restore)
+            else:
+                set_attr_temporarily(node + '.nodeState', 1, restore)  # has no effect
+    
+    for flag in profile.get('hide_types', []):
+        try:
+            if cmds.modelEditor(editor, q=True, **{flag: True}):
+                cmds.modelEditor(editor, e=True, **{flag: False})
+                restore.append((cmds.modelEditor, [editor], {'e': True, flag: True}))
+        except TypeError:
+            pass  # flag not in this Maya version
+
+
+def set_attr_temporarily(plug, value, restore):
+    current = cmds.getAttr(plug)
+    if current == value:
+        return
+    
+    try:
+        cmds.setAttr(plug, value)
+    except RuntimeError:
+        return  # locked or connected
+    
+    restore.append((cmds.setAttr, [plug, current], {}))
+
+
+def get_movie_dir():
+    # relative to the project, also for ffmpeg which does not know about the project
+    movieDir = os.path.join(pm.workspace(q=True, rootDirectory=True), pm.workspace.fileRules['movie']) + "/"
+    return movieDir.replace('\\', '/')
+
+
+def get_active_camera():
+    """
+    :return: Tuple of (camera transform, camera shape) of the active view
+    """
     view = OpenMayaUI.M3dView.active3dView()
     camPath = OpenMaya.MDagPath()
     view.getCamera(camPath)  # returns camera shape node
@@ -26,12 +306,17 @@ def custom_playblast():
     OpenMaya.MDagPath.getAPathTo(cam, camPath)
     camName = camPath.partialPathName()
     
-    # get render resolution
-    resolution = [int(pm.getAttr("defaultResolution.width")), int(pm.getAttr("defaultResolution.height"))]
-    
-    # prompt for postfix
-    message = "Camera: %s\n\nResolution: %dx%d\n\nFilename:" % (camName, resolution[0], resolution[1])
-    
+    return camName, camShapeName
+
+
+def get_resolution():
+    return [int(pm.getAttr("defaultResolution.width")), int(pm.getAttr("defaultResolution.height"))]
+
+
+def get_playblast_filename():
+    """
+    :return: Name of the movie without extension, as last used for the scene or based on the scene name
+    """
     filename = None
     try:
         filename = pm.system.fileInfo['playblastFilename']
@@ -49,38 +334,595 @@ def custom_playblast():
         if match is not None:
             filename = match.group(1)
     
-    result = pm.promptDialog(title="Playblast", message=message, button=["Playblast", "Cancel"],
-                             defaultButton="Playblast", cancelButton="Cancel", dismissString="Cancel", text=filename)
+    return filename
+
+
+def get_sound():
+    """
+    :return: Active sound in the time slider
+    """
+    aPlayBackSliderPython = maya.mel.eval('$tmpVar=$gPlayBackSlider')
+    return pm.timeControl(aPlayBackSliderPython, q=True, sound=True)
+
+
+def ffmpeg_playblast(filename, resolution, sound=None, preset='h264', start=None, end=None, background=True,
+                     viewer=True):
+    """
+    Playblast an image sequence to a temporary folder and encode it with ffmpeg.
+    :param filename: Movie file
+    :param resolution: [width, height]
+    :param sound: Sound node to add to the movie
+    :param preset: Name of the video options in FFMPEG_PRESETS
+    :param start: First frame, defaults to the start of the playback range
+    :param end: Last frame, defaults to the end of the playback range
+    :param background: Encode in a background thread and return right away
+    :param viewer: Open the movie when it is done
+    :return: True if the movie is written, or is being encoded in the background
+    """
+    if preset not in FFMPEG_PRESETS:
+        pm.error('Unknown ffmpeg preset "%s", use one of: %s' % (preset, ', '.join(sorted(FFMPEG_PRESETS))))
     
-    if result == "Playblast":
-        newName = pm.promptDialog(q=True, text=True)
+    if start is None:
+        start = int(pm.playbackOptions(q=True, minTime=True))
+    if end is None:
+        end = int(pm.playbackOptions(q=True, maxTime=True))
+    
+    tempDir = tempfile.mkdtemp(prefix='playblast_')
+    pm.animation.playblast(filename=os.path.join(tempDir, 'frame'), format='image', compression=IMAGE_FORMAT,
+                           framePadding=4, startTime=start, endTime=end, forceOverwrite=True, sequenceTime=False,
+                           clearCache=True, showOrnaments=False, offScreen=True, viewer=False, percent=100,
+                           quality=100, widthHeight=resolution)
+    
+    command = get_ffmpeg_command(os.path.join(tempDir, 'frame.%04d.' + IMAGE_FORMAT), filename, start,
+                                 get_fps(), get_sound_file(sound, start), preset)
+    
+    if background:
+        sys.stdout.write('# Encoding %s in the background...\n' % filename)
+        thread = threading.Thread(target=encode_in_background, args=(command, filename, tempDir, viewer))
+        thread.daemon = True
+        thread.start()
+        return True
+    
+    success, output = encode_movie(command, tempDir)
+    encode_finished(filename, success, output, viewer)
+    return success
+
+
+def incremental_playblast(filename, camShapeName, resolution, sound=None, preset='h264', start=None, end=None,
+                          background=True, viewer=True, profile=None):
+    """
+    Playblast only the frames that changed since the last playblast of the movie, and encode the movie with ffmpeg from
+    the frame cache.
+    :param filename: Movie file
+    :param camShapeName: Camera shape of the active view
+    :param resolution: [width, height]
+    :param sound: Sound node to add to the movie
+    :param preset: Name of the video options in FFMPEG_PRESETS
+    :param start: First frame, defaults to the start of the playback range
+    :param end: Last frame, defaults to the end of the playback range
+    :param background: Encode in a background thread and return right away
+    :param viewer: Open the movie when it is done
+    :param profile: Playblast profile applied while playblasting, e.g. FAST_PROFILE, frames cached with another
+                    profile are rendered again
+    :return: True if the movie is written, or is being encoded in the background
+    """
+    if preset not in FFMPEG_PRESETS:
+        pm.error('Unknown ffmpeg preset "%s", use one of: %s' % (preset, ', '.join(sorted(FFMPEG_PRESETS))))
+    
+    if start is None:
+        start = int(pm.playbackOptions(q=True, minTime=True))
+    if end is None:
+        end = int(pm.playbackOptions(q=True, maxTime=True))
+    
+    cacheDir = get_frame_cache_dir(filename)
+    if not os.path.isdir(cacheDir):
+        os.makedirs(cacheDir)
+    
+    # frames with the same state share an image, e.g. holds
+    hashes = get_frame_hashes(camShapeName, resolution, start, end, profile)
+    cached = set(os.path.splitext(f)[0] for f in os.listdir(cacheDir) if f.endswith('.' + IMAGE_FORMAT))
+    
+    dirty = {}
+    for frame in range(start, end + 1):
+        if hashes[frame] not in cached:
+            dirty[frame] = hashes[frame]
+            cached.add(hashes[frame])
+    
+    sys.stdout.write('# Rendering %d of %d frames, %d frames are cached\n' % (len(dirty), end - start + 1,
+                                                                           end - start + 1 - len(dirty)))
+    
+    if dirty:
+        pm.animation.playblast(filename=os.path.join(cacheDir, 'render'), format='image', compression=IMAGE_FORMAT,
+                               framePadding=4, frame=sorted(dirty), forceOverwrite=True, sequenceTime=False,
+                               clearCache=True, showOrnaments=False, offScreen=True, viewer=False, percent=100,
+                               quality=100, widthHeight=resolution)
         
-        if newName is not "":
-            filename = newName
+        for frame, frameHash in dirty.items():
+            image = os.path.join(cacheDir, 'render.%04d.%s' % (frame, IMAGE_FORMAT))
+            os.rename(image, os.path.join(cacheDir, '%s.%s' % (frameHash, IMAGE_FORMAT)))
+    
+    # remove frames that are no longer used
+    for frameHash in cached - set(hashes.values()):
+        os.remove(os.path.join(cacheDir, '%s.%s' % (frameHash, IMAGE_FORMAT)))
+    
+    # link the cached frames as an image sequence for ffmpeg
+    tempDir = tempfile.mkdtemp(prefix='sequence_', dir=cacheDir)
+    for frame in range(start, end + 1):
+        image = os.path.join(cacheDir, '%s.%s' % (hashes[frame], IMAGE_FORMAT))
+        link_file(image, os.path.join(tempDir, 'frame.%04d.%s' % (frame, IMAGE_FORMAT)))
+    
+    command = get_ffmpeg_command(os.path.join(tempDir, 'frame.%04d.' + IMAGE_FORMAT), filename, start,
+                                 get_fps(), get_sound_file(sound, start), preset)
+    
+    if background:
+        sys.stdout.write('# Encoding %s in the background...\n' % filename)
+        thread = threading.Thread(target=encode_in_background, args=(command, filename, tempDir, viewer))
+        thread.daemon = True
+        thread.start()
+        return True
+    
+    success, output = encode_movie(command, tempDir)
+    encode_finished(filename, success, output, viewer)
+    return success
+
+
+def chunked_playblast(filename, camShapeName, resolution, sound=None, preset='h264', start=None, end=None,
+                      background=True, viewer=True, chunks=None, executable=None, fast=False):
+    """
+    Playblast chunks of the frame range in parallel Maya sessions, and encode all frames with ffmpeg.
+    :param filename: Movie file
+    :param camShapeName: Camera shape to playblast through
+    :param resolution: [width, height]
+    :param sound: Sound node to add to the movie
+    :param preset: Name of the video options in FFMPEG_PRESETS
+    :param start: First frame, defaults to the start of the playback range
+    :param end: Last frame, defaults to the end of the playback range
+    :param background: Render and encode in a background thread and return right away
+    :param viewer: Open the movie when it is done
+    :param chunks: Number of chunks rendered at the same time, defaults to number of cpus
+    :param executable: Path to the Maya executable, defaults to the one of the running Maya
+    :param fast: Use the settings in FAST_PROFILE in each Maya session
+    :return: True if the movie is written, or is being rendered in the background
+    """
+    if preset not in FFMPEG_PRESETS:
+        pm.error('Unknown ffmpeg preset "%s", use one of: %s' % (preset, ', '.join(sorted(FFMPEG_PRESETS))))
+    
+    if start is None:
+        start = int(pm.playbackOptions(q=True, minTime=True))
+    if end is None:
+        end = int(pm.playbackOptions(q=True, maxTime=True))
+    
+    # the sessions open the scene from disk, so use a copy if there are unsaved changes
+    tempDir = tempfile.mkdtemp(prefix='playblast_')
+    scene = pm.system.sceneName()
+    if not scene or cmds.file(q=True, modified=True):
+        scene = os.path.join(tempDir, 'scene.mb')
+        cmds.file(scene, exportAll=True, type='mayaBinary', force=True, preserveReferences=True)
+    
+    camName = pm.listRelatives(camShapeName, parent=True)[0].name()
+    images = os.path.join(tempDir, 'frame')
+    
+    # one job for each chunk, all writing to the same image sequence
+    count = min(chunks or multiprocessing.cpu_count(), end - start + 1)
+    jobs = []
+    for i in range(count):
+        jobs.append({'scene': scene,
+                     'project': pm.workspace(q=True, rootDirectory=True),
+                     'camera': camName,
+                     'resolution': list(resolution),
+                     'start': start + (end - start + 1) * i // count,
+                     'end': start + (end - start + 1) * (i + 1) // count - 1,
+                     'images': images,
+                     'fast': fast})
+    
+    command = get_ffmpeg_command(images + '.%04d.' + IMAGE_FORMAT, filename, start, get_fps(),
+                                 get_sound_file(sound, start), preset)
+    
+    def render():
+        results = run_workers(jobs, count, executable)
+        failed = [logFile for job, code, logFile in results if code != 0]
         
-        pm.system.fileInfo['playblastFilename'] = filename
+        if failed:
+            output = 'Failed to playblast chunks, see:\n' + '\n'.join(failed)
+            shutil.rmtree(tempDir, ignore_errors=True)
+            return False, output
         
-        # get active sound in time slider
-        aPlayBackSliderPython = maya.mel.eval('$tmpVar=$gPlayBackSlider')
-        sound = pm.timeControl(aPlayBackSliderPython, q=True, sound=True)
+        return encode_movie(command, tempDir)
+    
+    if background:
+        sys.stdout.write('# Rendering %s in %d chunks in the background...\n' % (filename, count))
         
-        # assemble full path and filename
-        filename = movieDir + filename + ".mov"
+        def render_in_background():
+            success, output = render()
+            maya.utils.executeDeferred(encode_finished, filename, success, output, viewer)
         
-        # disable resolution gate
-        resGateEnabled = pm.getAttr(camShapeName + ".displayResolution")
-        overscan = pm.getAttr(camShapeName + ".overscan")
-        pm.setAttr(camShapeName + ".displayResolution", 1)
-        pm.setAttr(camShapeName + ".overscan", 1)
+        thread = threading.Thread(target=render_in_background)
+        thread.daemon = True
+        thread.start()
+        return True
+    
+    success, output = render()
+    encode_finished(filename, success, output, viewer)
+    return success
+
+
+def get_frame_cache_dir(filename):
+    return os.path.join(os.path.dirname(filename), CACHE_DIR, os.path.splitext(os.path.basename(filename))[0])
+
+
+def clear_frame_cache(filename=None):
+    """
+    Remove the cached frames of a movie, so the next incremental playblast renders every frame
+    :param filename: Movie file, defaults to the movie custom_playblast would suggest
+    """
+    if filename is None:
+        filename = get_movie_dir() + get_playblast_filename() + '.mov'
+    shutil.rmtree(get_frame_cache_dir(filename), ignore_errors=True)
+
+
+def get_frame_hashes(camShapeName, resolution, start, end, profile=None):
+    """
+    Hash the evaluated state that affects the image of each frame: the camera, and the transform, bounding box and
+    visibility of all geometry. Frames are evaluated in a DG context, without changing the current time.
+    The display settings of the playblast editor and the playblast profile are part of every hash.
+    :return: Dictionary of frame: hash
+    """
+    names = [camShapeName + '.worldMatrix[0]']
+    names += ['%s.%s' % (camShapeName, attr) for attr in CAMERA_ATTRIBUTES]
+    
+    visibility = set()
+    for shape in cmds.ls(type=['mesh', 'nurbsSurface', 'nurbsCurve', 'subdiv'], noIntermediate=True, long=True):
+        names.append(shape + '.worldMatrix[0]')
+        names += [shape + '.boundingBox' + attr for attr in ('MinX', 'MinY', 'MinZ', 'MaxX', 'MaxY', 'MaxZ')]
         
-        # playblast!
-        pm.animation.playblast(filename=filename, format="qt", compression="H.264", forceOverwrite=True,
-                               sequenceTime=False, clearCache=True, showOrnaments=False, offScreen=True, viewer=True,
-                               percent=100, quality=100, widthHeight=resolution, sound=sound)
+        # visibility of the shape and its parents
+        path = shape
+        while path:
+            visibility.add(path + '.visibility')
+            path = path.rsplit('|', 1)[0]
+    
+    names += sorted(visibility)
+    
+    plugs = [om.MSelectionList().add(name).getPlug(0) for name in names]
+    matrices = [name.endswith('.worldMatrix[0]') for name in names]
+    settings = repr((CACHE_VERSION, camShapeName, list(resolution), IMAGE_FORMAT, names, get_editor_state(),
+                     sorted((profile or {}).items()))).encode('utf-8')
+    
+    hashes = {}
+    unit = om.MTime.uiUnit()
+    for frame in range(start, end + 1):
+        context = om.MDGContext(om.MTime(frame, unit))
+        values = []
         
-        # restore gate
-        pm.setAttr(camShapeName + ".displayResolution", resGateEnabled)
-        pm.setAttr(camShapeName + ".overscan", overscan)
+        if hasattr(context, 'makeCurrent'):  # Maya 2018 and later
+            previous = context.makeCurrent()
+            try:
+                for plug, matrix in zip(plugs, matrices):
+                    values.append(get_plug_value(plug, matrix))
+            finally:
+                previous.makeCurrent()
+        else:
+            for plug, matrix in zip(plugs, matrices):
+                values.append(get_plug_value(plug, matrix, context))
+        
+        sha = hashlib.sha1(settings)
+        sha.update(repr(values).encode('utf-8'))
+        hashes[frame] = sha.hexdigest()
+    
+    return hashes
+
+
+def get_editor_state(editor=None):
+    """
+    :param editor: Model editor, defaults to the one the playblast uses
+    :return: List of (flag, value) for EDITOR_FLAGS
+    """
+    editor = editor or cmds.playblast(activeEditor=True)
+    state = []
+    
+    for flag in EDITOR_FLAGS:
+        try:
+            state.append((flag, cmds.modelEditor(editor, q=True, **{flag: True})))
+        except (TypeError, RuntimeError):
+            pass  # flag not in this Maya version
+    
+    return state
+
+
+def get_plug_value(plug, matrix=False, context=None):
+    """
+    :return: Value of a numeric or matrix plug, rounded so tiny float differences are ignored
+    """
+    args = [context] if context is not None else []
+    
+    if matrix:
+        value = om.MFnMatrixData(plug.asMObject(*args)).matrix()
+        return tuple(round(value[i], 5) for i in range(16))
+    
+    return round(plug.asDouble(*args), 5)
+
+
+def link_file(source, destination):
+    # hardlink when possible, the cache can be large
+    try:
+        os.link(source, destination)
+    except (AttributeError, OSError):
+        shutil.copyfile(source, destination)
+
+
+def get_ffmpeg_command(images, filename, start, fps, sound=None, preset='h264'):
+    """
+    :param images: Image sequence, e.g. /tmp/frame.%04d.tif
+    :param filename: Movie file
+    :param start: First frame of the image sequence
+    :param fps: Frames per second
+    :param sound: Tuple of (sound file, offset in seconds) or None
+    :param preset: Name of the video options in FFMPEG_PRESETS
+    :return: ffmpeg command as a list
+    """
+    ffmpeg = os.environ.get('FFMPEG', 'ffmpeg')
+    command = [ffmpeg, '-y', '-loglevel', 'error', '-framerate', str(fps), '-start_number', str(start), '-i', images]
+    
+    if sound:
+        # pad the audio with silence and end with the video, so a short sound never cuts off frames
+        command += ['-itsoffset', str(sound[1]), '-i', sound[0], '-map', '0:v', '-map', '1:a', '-c:a', 'aac',
+                    '-af', 'apad', '-shortest']
+    
+    # h264 and most other codecs need an even width and height
+    command += ['-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2']
+    command += FFMPEG_PRESETS[preset]
+    command.append(filename)
+    return command
+
+
+def encode_movie(command, tempDir):
+    """
+    Run ffmpeg and remove the image sequence
+    :return: Tuple of (success, ffmpeg output)
+    """
+    try:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = process.communicate()[0].decode('utf-8', 'replace')
+        success = process.returncode == 0
+    except OSError as e:
+        output = 'Could not run ffmpeg: %s' % e
+        success = False
+    finally:
+        shutil.rmtree(tempDir, ignore_errors=True)
+    
+    return success, output
+
+
+def encode_in_background(command, filename, tempDir, viewer=True):
+    """
+    Encode the movie, reporting back to Maya when done. Runs in a background thread.
+    """
+    success, output = encode_movie(command, tempDir)
+    maya.utils.executeDeferred(encode_finished, filename, success, output, viewer)
+
+
+def encode_finished(filename, success, output='', viewer=True):
+    if not success:
+        sys.stdout.write(output + '\n')
+        pm.warning('Could not encode %s, see script editor for details.' % filename)
+        return
+    
+    sys.stdout.write('# Saved playblast to: %s\n' % filename)
+    if pm.about(batch=True):
+        return
+    
+    pm.inViewMessage(assistMessage='Playblast done: <hl>%s</hl>' % os.path.basename(filename), position='topCenter',
+                     fade=True)
+    
+    if viewer:
+        if platform.system() == 'Darwin':
+            subprocess.call(['open', filename])  # MacOS
+        else:
+            webbrowser.open(filename)  # Windows, Linux
+
+
+def get_fps():
+    return pm.mel.eval('currentTimeUnitToFPS()')
 
 
-custom_playblast()
+def get_sound_file(sound, start):
+    """
+    :return: Tuple of (sound file, offset in seconds from the start frame) or None
+    """
+    if not sound:
+        return None
+    
+    soundFile = pm.getAttr(sound + '.filename')
+    if soundFile and not os.path.isabs(soundFile):
+        soundFile = cmds.workspace(expandName=soundFile)  # relative to the project
+    
+    if not soundFile or not os.path.isfile(soundFile):
+        return None
+    
+    return soundFile, (pm.getAttr(sound + '.offset') - start) / float(get_fps())
+
+
+def get_maya():
+    name = 'maya.exe' if os.name == 'nt' else 'maya'
+    location = os.environ.get('MAYA_LOCATION')
+    
+    if location and os.path.isfile(os.path.join(location, 'bin', name)):
+        return os.path.join(location, 'bin', name)
+    
+    return name  # hope it is on the path
+
+
+def get_script_path():
+    return os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+
+
+def get_project_dir(scene):
+    """
+    :return: Maya project folder of a scene, i.e. the first parent folder with a workspace.mel, or None
+    """
+    folder = os.path.dirname(os.path.abspath(scene))
+    while True:
+        if os.path.isfile(os.path.join(folder, 'workspace.mel')):
+            return folder
+        
+        parent = os.path.dirname(folder)
+        if parent == folder:
+            return None
+        folder = parent
+
+
+def get_job_filename(job):
+    """
+    :return: Movie file of a job, after the scene of the job is opened
+    """
+    movieDir = job.get('movie_dir')
+    if movieDir is None:
+        movieDir = get_movie_dir()
+    if not movieDir.endswith('/'):
+        movieDir += '/'
+    
+    filename = job.get('filename') or get_playblast_filename()
+    return movieDir + filename + '.mov'
+
+
+def run_job(job):
+    """
+    Open the scene of a job and playblast it. Used by the batch workers.
+    :param job: Dictionary with "scene" and optional "camera", "start", "end", "filename", "movie_dir", "encoder" and
+                "preset". Chunks of chunked_playblast also have "project", "resolution" and "images", the image
+                sequence to write instead of a movie.
+    :return: True if the movie is written
+    """
+    project = job.get('project') or get_project_dir(job['scene'])
+    if project:
+        pm.workspace(project, openWorkspace=True)
+    
+    pm.openFile(job['scene'], force=True)
+    
+    camName = job.get('camera', 'persp')
+    camShapeName = (pm.listRelatives(camName, shapes=True, type='camera') or [pm.PyNode(camName)])[0].name()
+    
+    # look through the camera in the first model panel
+    panel = (pm.getPanel(visiblePanels=True, type='modelPanel') or pm.getPanel(type='modelPanel'))[0]
+    pm.modelPanel(panel, edit=True, camera=camName)
+    pm.setFocus(panel)
+    
+    resolution = job.get('resolution') or get_resolution()
+    
+    if job.get('images'):
+        return playblast_camera(job['images'], camShapeName, resolution, encoder='images', start=job.get('start'),
+                                end=job.get('end'), viewer=False, fast=job.get('fast', False))
+    
+    filename = get_job_filename(job)
+    folder = os.path.dirname(filename)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    
+    return playblast_camera(filename, camShapeName, resolution, get_sound(), job.get('encoder', 'ffmpeg'),
+                            job.get('preset', 'h264'), job.get('start'), job.get('end'), background=False,
+                            viewer=False, fast=job.get('fast', False))
+
+
+def run_job_file(path):
+    """
+    Run the job in a JSON file and quit Maya, with exit code 0 if the movie is written. Used by the batch workers.
+    """
+    code = 1
+    try:
+        with open(path) as f:
+            if run_job(json.load(f)):
+                code = 0
+    except Exception:
+        traceback.print_exc()
+    
+    sys.stdout.flush()
+    cmds.quit(force=True, exitCode=code)
+
+
+def get_worker_command(job_file, maya=None):
+    """
+    :return: Command starting a Maya session that runs a job file and quits
+    """
+    script = 'import sys; sys.path.insert(0, %r); import playblast; playblast.run_job_file(%r)' % (
+        os.path.dirname(get_script_path()), job_file)
+    
+    # MEL consumes one level of backslashes, so escape them again, or windows paths like C:\Users break in python
+    script = script.replace('\\', '\\\\').replace('"', '\\"')
+    command = [maya or get_maya(), '-noAutoloadPlugins', '-command', 'python("%s")' % script]
+    
+    # offscreen on Linux without a display
+    if platform.system() == 'Linux' and not os.environ.get('DISPLAY'):
+        command = ['xvfb-run', '--auto-servernum', '--server-args=-screen 0 1920x1080x24'] + command
+    
+    return command
+
+
+def run_workers(jobs, processes=None, maya=None):
+    """
+    Run jobs in parallel, each job in its own Maya session.
+    :return: List of (job, return code, log file) tuples
+    """
+    processes = processes or multiprocessing.cpu_count()
+    jobDir = tempfile.mkdtemp(prefix='playblast_')
+    
+    def run(args):
+        i, job = args
+        jobFile = os.path.join(jobDir, 'job_%04d.json' % i)
+        logFile = os.path.join(jobDir, 'job_%04d.log' % i)
+        
+        with open(jobFile, 'w') as f:
+            json.dump(job, f)
+        
+        with open(logFile, 'w') as log:
+            code = subprocess.call(get_worker_command(jobFile, maya), stdout=log, stderr=subprocess.STDOUT)
+        
+        return job, code, logFile
+    
+    pool = ThreadPool(processes)
+    try:
+        return pool.map(run, list(enumerate(jobs)))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def batch_playblast(jobs, processes=None, maya=None):
+    """
+    Playblast jobs in parallel, each job in its own Maya session.
+    :param jobs: List of job dictionaries, see run_job
+    :param processes: Max. number of processes running at the same time, defaults to number of cpus
+    :param maya: Path to the Maya executable, defaults to the one of the running Maya
+    :return: List of (job, return code, log file) tuples
+    """
+    results = run_workers(jobs, processes, maya)
+    
+    failed = 0
+    for job, code, logFile in results:
+        if code == 0:
+            sys.stdout.write('# Playblasted %s\n' % job['scene'])
+        else:
+            sys.stdout.write('# Failed to playblast %s, see %s\n' % (job['scene'], logFile))
+            failed += 1
+    
+    sys.stdout.write('# Batch playblast done: %d of %d jobs failed\n' % (failed, len(results)))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Playblast scenes in parallel Maya sessions.')
+    parser.add_argument('jobs', help='JSON file with a list of jobs')
+    parser.add_argument('--processes', type=int, default=0, help='Number of processes, defaults to number of cpus')
+    args = parser.parse_args(argv)
+    
+    with open(args.jobs) as f:
+        jobs = json.load(f)
+    
+    results = batch_playblast(jobs, args.processes)
+    return int(any(code != 0 for job, code, logFile in results))
+
+
+if __name__ == '__main__':
+    if pm.about(batch=True):
+        sys.exit(main())  # mayapy
+    
+    custom_playblast()
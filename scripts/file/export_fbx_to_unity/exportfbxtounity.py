@@ -16,17 +16,47 @@ Save script in Maya's scripts folder.
 ## Execute as Python in Maya
 import exportfbxtounity
 exportfbxtounity.create()
+
+
+## Batch export
+Export a list of jobs in parallel headless mayapy processes, either from Maya:
+
+import exportfbxtounity
+exportfbxtounity.batch_export(jobs, processes=8)
+
+or from a shell, with the jobs saved as a JSON file:
+
+mayapy exportfbxtounity.py jobs.json --processes 8
+
+Each job is a dictionary with the scene to open, the nodes to export and the export options, e.g.
+{"scene": "/project/scenes/run.ma", "nodes": ["root"], "save_dir": "/unity/Assets/Animation",
+ "file_name": "Hero@Run.fbx", "bake_animation": true, "clips": [["Run", 1, 24]]}
+
+"time_range" is optional. All other keys are passed to FbxExporter. Scenes are never saved by the batch export.
+"fbx_preset" is a preset file saved with FbxExportPreset.save, for the same fbx options in every batch run.
 """
 
 import pymel.core as pm
 import maya.cmds as cmds
 import maya.OpenMayaUI as omui
 import maya.api.OpenMaya as om
+import maya.api.OpenMayaAnim as oma
 import maya.utils
 import maya.mel
 import os
 import json
 import sys
+import hashlib
+import argparse
+import multiprocessing
+import subprocess
+import shutil
+import tempfile
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 qt_version = 5
 try:
@@ -41,8 +71,58 @@ except ImportError:
     
     qt_version = 4
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 window = None
 
+FBX_FILE_VERSION = 'FBX201800'  # FBX202000 | FBX201900 | FBX201800 | FBX201600 | FBX201400 | FBX201300 | FBX201200 | FBX201100 | FBX201000 | FBX200900 | FBX200611
+
+# fbx options applied on export, in order. Animation only, constraints, input connections and the time range are
+# set from the exporter options
+DEFAULT_FBX_OPTIONS = [
+    ('FBXExportAnimationOnly', False),
+    ('FBXExportBakeComplexAnimation', False),
+    ('FBXExportBakeComplexStart', 0),
+    ('FBXExportBakeComplexEnd', 0),
+    ('FBXExportBakeResampleAnimation', False),
+    ('FBXExportCameras', True),
+    ('FBXExportConstraints', False),
+    ('FBXExportLights', True),
+    ('FBXExportQuaternion', 'quaternion'),
+    ('FBXExportAxisConversionMethod', 'none'),
+    ('FBXExportApplyConstantKeyReducer', False),
+    ('FBXExportSmoothMesh', False),  # do not export subdivision version
+    ('FBXExportShapes', True),  # needed for skins and blend shapes
+    ('FBXExportSkins', True),
+    ('FBXExportSkeletonDefinitions', True),
+    ('FBXExportEmbeddedTextures', False),
+    ('FBXExportInputConnections', False),
+    ('FBXExportInstances', True),  # preserve instances by sharing same mesh
+    ('FBXExportUseSceneName', True),
+    ('FBXExportFileVersion', FBX_FILE_VERSION),
+    ('FBXExportGenerateLog', False),
+    ('FBXExportInAscii', False),
+]
+
+# index of the middle axis for each rotateOrder: xyz, yzx, zxy, xzy, yxz, zyx
+ROTATE_ORDER_MIDDLE = (1, 2, 0, 2, 0, 1)
+
+# stored in the export folder, remembers what was exported last time
+MANIFEST_NAME = '.exportfbxtounity_manifest.json'
+MANIFEST_VERSION = 1  # bump when the export process changes, so every file is exported again
+
+# written next to each fbx file with export_sidecar, describes what was exported
+SIDECAR_SUFFIX = '.fbx.json'
+SIDECAR_VERSION = 1
+
+# exit codes of batch workers, 2 is used by argparse for bad arguments
+EXIT_EXPORTED = 0
+EXIT_FAILED = 1
+EXIT_SKIPPED = 3  # up to date, nothing exported
+
 
 def get_main_maya_window():
     ptr = omui.MQtUtil.mainWindow()
@@ -93,7 +173,7 @@ class ExportFbxToUnity(QMainWindow):
         self.setProperty("saveWindowPref", True)
         
         self.original_selection = None
-        self.transform_attributes = ['tx', 'ty', 'tz', 'rx', 'ry', 'rz', 'sx', 'sy', 'sz', 'visibility']
+        self.exporter = None
         
         # qt widgets
         self.input_connections_layout = QHBoxLayout()
@@ -101,6 +181,21 @@ class ExportFbxToUnity(QMainWindow):
         self.input_connections_checkbox = QCheckBox()
         self.input_connections_checkbox.clicked.connect(self.save_input_connections_option)
         
+        self.skip_unchanged_layout = QHBoxLayout()
+        self.skip_unchanged_label = self.create_label('Skip unchanged:')
+        self.skip_unchanged_checkbox = QCheckBox()
+        self.skip_unchanged_checkbox.clicked.connect(self.save_skip_unchanged_option)
+        
+        self.export_report_layout = QHBoxLayout()
+        self.export_report_label = self.create_label('Export report:')
+        self.export_report_checkbox = QCheckBox()
+        self.export_report_checkbox.clicked.connect(self.save_export_report_option)
+        
+        self.export_sidecar_layout = QHBoxLayout()
+        self.export_sidecar_label = self.create_label('Export sidecar:')
+        self.export_sidecar_checkbox = QCheckBox()
+        self.export_sidecar_checkbox.clicked.connect(self.save_export_sidecar_option)
+        
         self.constraints_layout = QHBoxLayout()
         self.constraints_label = self.create_label('Constraints:')
         self.constraints_checkbox = QCheckBox()
@@ -126,6 +221,12 @@ class ExportFbxToUnity(QMainWindow):
         self.has_stepped_label = self.create_label('Has stepped tangents')
         self.has_stepped_checkbox = QCheckBox()
         self.has_stepped_checkbox.clicked.connect(self.save_has_stepped_option)
+        self.reduce_keys_label = self.create_label('Reduce keys')
+        self.reduce_keys_checkbox = QCheckBox()
+        self.reduce_keys_checkbox.clicked.connect(self.save_reduce_keys_option)
+        self.context_bake_label = self.create_label('Sample without scrubbing')
+        self.context_bake_checkbox = QCheckBox()
+        self.context_bake_checkbox.clicked.connect(self.save_context_bake_option)
         
         self.time_slider_radio = QRadioButton('Time slider')
         self.start_end_radio = QRadioButton('Start/end')
@@ -142,6 +243,9 @@ class ExportFbxToUnity(QMainWindow):
         self.animation_clip_label = self.create_label('Animation clips:')
         self.animation_clip_checkbox = QCheckBox()
         self.animation_clip_checkbox.clicked.connect(self.save_animation_clip_option)
+        self.split_clips_label = QLabel('Separate files')
+        self.split_clips_checkbox = QCheckBox()
+        self.split_clips_checkbox.clicked.connect(self.save_split_clips_option)
         
         self.clip_data = [
             ["Take 001", int(pm.playbackOptions(q=True, min=True)), int(pm.playbackOptions(q=True, max=True))]]
@@ -165,11 +269,7 @@ class ExportFbxToUnity(QMainWindow):
         self.new_callback = om.MSceneMessage.addCallback(om.MSceneMessage.kAfterNew, self.after_open_file)
         
         # try to load fbx plugin
-        if not pm.pluginInfo('fbxmaya.bundle', q=True, loaded=True):
-            try:
-                pm.loadPlugin('fbxmaya.bundle')
-            except:
-                pm.warning('# Could not load FBX plugin.')
+        load_fbx_plugin()
         
         # create and open the ui
         self.create_window()
@@ -227,11 +327,26 @@ class ExportFbxToUnity(QMainWindow):
         
         # options
         self.input_connections_checkbox.setToolTip('Include input connections when exporting.')
+        self.skip_unchanged_checkbox.setToolTip('Do not bake and export if nothing changed since the last export.')
+        self.export_report_checkbox.setToolTip('Write the time spent in each export phase to '
+                                               'MyCharacter_export_report.json next to the FBX file.')
+        self.export_sidecar_checkbox.setToolTip('Write the clips, channels and content hashes of the export to '
+                                                'MyCharacter.fbx.json next to the FBX file.')
         self.animation_only_checkbox.setToolTip('Only export animation without geometry. '
                                                 'Useful for character animation.')
         self.bake_animation_checkbox.setToolTip('Use a customized bake method. '
-                                                'For safety, this requires saving the file before.')
+                                                'The bake is either undone after export, or the file is saved before.')
         self.euler_filter_checkbox.setToolTip('Apply euler filter to rotation after baking.')
+        self.reduce_keys_checkbox.setToolTip('After baking animation, remove keys that are not needed to reproduce the '
+                                             'motion.\n\nNot used together with stepped tangents.')
+        self.context_bake_checkbox.setToolTip('Bake by evaluating only the animated channels at each frame, without '
+                                              'changing the current time. Usually several times faster.\n\n'
+                                              'Do not use with simulations, e.g. dynamics or expressions that depend '
+                                              'on the previous frame. Joints in ik chains are baked the normal way.')
+        self.split_clips_checkbox.setToolTip('Export each clip as its own animation only file, named like '
+                                             'MyCharacter@ClipName.fbx.\n\n'
+                                             'The clips are exported in parallel in the background, from the saved '
+                                             'scene or a temporary copy of it.')
         self.has_stepped_checkbox.setToolTip('After baking animation, attempt to set tangents to step.\n\n'
                                              'IMPORTANT: Untick "Resample Curves" in Unity to keep the stepped '
                                              'tangents.')
@@ -242,6 +357,15 @@ class ExportFbxToUnity(QMainWindow):
         self.input_connections_layout.addWidget(self.input_connections_label)
         self.input_connections_layout.addWidget(self.input_connections_checkbox)
         
+        self.skip_unchanged_layout.addWidget(self.skip_unchanged_label)
+        self.skip_unchanged_layout.addWidget(self.skip_unchanged_checkbox)
+        
+        self.export_report_layout.addWidget(self.export_report_label)
+        self.export_report_layout.addWidget(self.export_report_checkbox)
+        
+        self.export_sidecar_layout.addWidget(self.export_sidecar_label)
+        self.export_sidecar_layout.addWidget(self.export_sidecar_checkbox)
+        
         self.constraints_layout.addWidget(self.constraints_label)
         self.constraints_layout.addWidget(self.constraints_checkbox)
         
@@ -255,9 +379,16 @@ class ExportFbxToUnity(QMainWindow):
         self.bake_animation_layout.addWidget(self.euler_filter_checkbox, 1, 1)
         self.bake_animation_layout.addWidget(self.has_stepped_label, 2, 0)
         self.bake_animation_layout.addWidget(self.has_stepped_checkbox, 2, 1)
+        self.bake_animation_layout.addWidget(self.reduce_keys_label, 3, 0)
+        self.bake_animation_layout.addWidget(self.reduce_keys_checkbox, 3, 1)
+        self.bake_animation_layout.addWidget(self.context_bake_label, 4, 0)
+        self.bake_animation_layout.addWidget(self.context_bake_checkbox, 4, 1)
         
         self.animation_clip_layout.addWidget(self.animation_clip_label)
         self.animation_clip_layout.addWidget(self.animation_clip_checkbox)
+        self.animation_clip_layout.addWidget(self.split_clips_checkbox)
+        self.animation_clip_layout.addWidget(self.split_clips_label)
+        self.animation_clip_layout.addStretch()
         
         # time slider and start/end
         self.time_layout = QHBoxLayout()
@@ -328,6 +459,9 @@ class ExportFbxToUnity(QMainWindow):
         inner_vertical_layout.addLayout(self.animation_only_layout)
         inner_vertical_layout.addLayout(self.constraints_layout)
         inner_vertical_layout.addLayout(self.input_connections_layout)
+        inner_vertical_layout.addLayout(self.skip_unchanged_layout)
+        inner_vertical_layout.addLayout(self.export_report_layout)
+        inner_vertical_layout.addLayout(self.export_sidecar_layout)
         inner_vertical_layout.addLayout(self.create_separator_layout())
         inner_vertical_layout.addLayout(self.bake_animation_layout)
         inner_vertical_layout.addLayout(self.create_separator_layout())
@@ -383,9 +517,15 @@ class ExportFbxToUnity(QMainWindow):
         self.euler_filter_checkbox.setEnabled(checked)
         self.has_stepped_label.setEnabled(checked)
         self.has_stepped_checkbox.setEnabled(checked)
+        self.reduce_keys_label.setEnabled(checked)
+        self.reduce_keys_checkbox.setEnabled(checked)
+        self.context_bake_label.setEnabled(checked)
+        self.context_bake_checkbox.setEnabled(checked)
     
     def toggle_animation_clip(self, checked):
         self.table_widget.setEnabled(checked)
+        self.split_clips_label.setEnabled(checked)
+        self.split_clips_checkbox.setEnabled(checked)
         self.add_clip_button.setEnabled(checked)
         self.remove_clip_button.setEnabled(checked)
         
@@ -509,6 +649,8 @@ class ExportFbxToUnity(QMainWindow):
             return
         
         self.original_selection = pm.ls(sl=True)
+        self.exporter = self.create_exporter()
+        self.exporter.original_selection = self.original_selection
         
         time_range = self.get_time_range()
         
@@ -516,35 +658,98 @@ class ExportFbxToUnity(QMainWindow):
             pm.error('Could not determine time range.')
             return
         
+        # export each clip to its own file in separate processes
+        if self.animation_clip_checkbox.isChecked() and self.split_clips_checkbox.isChecked():
+            self.export_split_clips()
+            return
+        
+        # skip if nothing changed since last export
+        export_hash = None
+        if self.exporter.skip_unchanged:
+            export_hash = self.exporter.get_export_hash(time_range)
+            if self.exporter.is_up_to_date(export_hash):
+                sys.stdout.write('# %s is up to date, skipped export\n' % self.exporter.get_export_path())
+                return
+        
         try:
             cycle_check = pm.cycleCheck(q=True, evaluation=True)
             pm.cycleCheck(evaluation=False)
             
             # if "bake animation" is checked
             if self.bake_animation_checkbox.isChecked():
-                self.bake(time_range)
+                success = self.bake(time_range)
             else:
-                self.export_fbx(time_range)
+                success = self.exporter.export_fbx(time_range)
             
             pm.cycleCheck(evaluation=cycle_check)
+            
+            if success and export_hash is not None:
+                self.exporter.save_export_hash(export_hash)
         except Exception as e:
             sys.stdout.write(str(e) + '\n')
     
-    def bake(self, time_range):
-        # if file has never been saved
-        if pm.system.sceneName() == '':
-            pm.confirmDialog(title='Scene never saved',
-                             message='Your scene has never been saved.\n\n'
-                                     'Please save your scene and try again.',
-                             button=['OK'])
-            return
+    def export_split_clips(self):
+        # workers open the scene from disk, so use a copy if there are unsaved changes
+        scene = pm.system.sceneName()
+        temp_dir = None
         
+        if not scene or cmds.file(q=True, modified=True):
+            temp_dir = tempfile.mkdtemp(prefix='exportfbxtounity_')
+            scene = os.path.join(temp_dir, 'scene.mb')
+            cmds.file(scene, exportAll=True, type='mayaBinary', force=True, preserveReferences=True)
+        
+        jobs = self.exporter.get_clip_jobs(self.original_selection, scene)
+        
+        # wait for the workers in a thread, so maya can be used in the meantime
+        def run():
+            try:
+                results = run_batch(jobs)
+            except Exception:
+                maya.utils.executeDeferred(sys.stdout.write, traceback.format_exc())
+                return
+            finally:
+                if temp_dir:
+                    shutil.rmtree(temp_dir, ignore_errors=True)
+            
+            maya.utils.executeDeferred(report_batch, results)
+        
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        
+        sys.stdout.write('# Exporting %d clips in the background...\n' % len(jobs))
+    
+    def create_exporter(self):
+        clips = None
+        if self.animation_clip_checkbox.isChecked():
+            clips = self.clip_data
+        
+        return FbxExporter(save_dir=self.save_dir,
+                           file_name=self.file_name,
+                           input_connections=self.input_connections_checkbox.isChecked(),
+                           constraints=self.constraints_checkbox.isChecked(),
+                           animation_only=self.animation_only_checkbox.isChecked(),
+                           bake_animation=self.bake_animation_checkbox.isChecked(),
+                           euler_filter=self.euler_filter_checkbox.isChecked(),
+                           has_stepped=self.has_stepped_checkbox.isChecked(),
+                           reduce_keys=self.reduce_keys_checkbox.isChecked(),
+                           context_bake=self.context_bake_checkbox.isChecked(),
+                           clips=clips,
+                           skip_unchanged=self.skip_unchanged_checkbox.isChecked(),
+                           export_report=self.export_report_checkbox.isChecked(),
+                           export_sidecar=self.export_sidecar_checkbox.isChecked())
+    
+    def bake(self, time_range):
         # if asked to skip confirmation message (0 is default)
-        confirm = pm.confirmDialog(title='Bake animation is NOT undoable!',
-                                   message='Do you want to save before baking the animation and re-open the file after '
-                                           'it is done? This action cannot be undone!\n\n'
+        confirm = pm.confirmDialog(title='Bake animation',
+                                   message='Bake and Restore undoes the bake after exporting, leaving your scene as it '
+                                           'was.\n\n'
+                                           'Otherwise, do you want to save before baking the animation and re-open the '
+                                           'file after it is done? This action cannot be undone!\n\n'
                                            'Baking also removes animation layers.',
-                                   button=['Save and Bake Animation', 'Bake Without Saving', 'Cancel'],
+                                   button=['Bake and Restore', 'Save and Bake Animation', 'Bake Without Saving',
+                                           'Cancel'],
+                                   defaultButton='Bake and Restore',
                                    cancelButton='Cancel',
                                    dismissString='Cancel')
         
@@ -553,24 +758,23 @@ class ExportFbxToUnity(QMainWindow):
         
         # save original file
         if confirm == 'Save and Bake Animation':
+            # if file has never been saved
+            if pm.system.sceneName() == '':
+                pm.confirmDialog(title='Scene never saved',
+                                 message='Your scene has never been saved.\n\n'
+                                         'Please save your scene and try again.',
+                                 button=['OK'])
+                return
+            
             original_file = pm.saveFile(force=True)
             qApp.processEvents()
         
         # disable viewport
         maya.mel.eval("paneLayout -e -manage false $gMainPane")
         
-        # set playback range (appears that fbx uses it for the range when exporting)
-        pm.playbackOptions(min=time_range[0], max=time_range[1])
-        
-        try:
-            # bake keys
-            self.custom_bake(time_range)
-            self.remove_non_transform_curves()
-        except Exception as e:
-            sys.stdout.write(str(e) + '\n')
-        
+        success = False
         try:
-            self.export_fbx(time_range)
+            success = self.exporter.bake_and_export(time_range, restore=confirm == 'Bake and Restore')
         except Exception as e:
             sys.stdout.write(str(e) + '\n')
         
@@ -591,6 +795,8 @@ class ExportFbxToUnity(QMainWindow):
                     pm.openFile(original_file, force=True)
             except Exception as e:
                 sys.stdout.write(str(e) + '\n')
+        
+        return success
     
     def get_time_range(self):
         if self.animation_clip_checkbox.isChecked() and self.clip_data:
@@ -611,263 +817,6 @@ class ExportFbxToUnity(QMainWindow):
             return sorted((int(float(self.start_input.text())), int(float(self.end_input.text()))))
         return None
     
-    def custom_bake(self, time_range):
-        stepped_limit = 0.0001
-        
-        # get objects to bake
-        # baked_objects = list(self.original_selection)  # copy the list
-        # joints = pm.listRelatives(self.original_selection, allDescendents=True, type='joint')
-        # baked_objects.extend(pm.listRelatives(self.original_selection, allDescendents=True, type='transform'))
-        
-        # pm.select(baked_objects, r=True)
-        
-        # obj_list = om.MGlobal.getActiveSelectionList()
-        # iterator = om.MItSelectionList(obj_list, om.MFn.kDagNode)
-        try:
-            to_bake = pm.ls(self.original_selection, type='transform')
-            to_bake += pm.listRelatives(self.original_selection, allDescendents=True, type='transform')
-            
-            # create a set, and add all joints to the set
-            filtered = set(pm.ls(self.original_selection, type='joint'))
-            filtered |= set(pm.listRelatives(self.original_selection, allDescendents=True, type='joint'))  # union op.
-        except Exception as e:
-            sys.stdout.write("error 1: %s\n" % e)
-        
-        # add blendshapes and animated transforms to the set
-        blendshapes = set()
-        for node in to_bake:
-            # blendshape?
-            try:
-                for shape in node.getShapes():
-                    shape_inputs = shape.inputs()
-                    # shape_inputs.extend(shape.attr('inMesh').inputs())  # maybe not needed
-                    
-                    # this should perhaps be rewritten as a recursive function,
-                    # that keeps traversing down the hierarchy
-                    for shape_input in shape_inputs:
-                        if pm.nodeType(shape_input) == 'blendShape':
-                            blendshapes.add(shape_input)
-                        elif pm.nodeType(shape_input) in ('skinCluster', 'objectSet'):
-                            for inp in shape_input.inputs():
-                                if pm.nodeType(inp) == 'blendShape':
-                                    blendshapes.add(inp)
-            except Exception as e:
-                pm.warning("Could not determine blendshape: %s" % e)
-            
-            # any inputs to transform attributes? i.e. any animation?
-            for at in self.transform_attributes:
-                if pm.hasAttr(node, at) and len(node.attr(at).inputs()) > 0:
-                    filtered.add(node)
-                    break
-        
-        to_bake = list(filtered.union(blendshapes))
-        
-        samples = 1
-        has_stepped = self.has_stepped_checkbox.isChecked()
-        if has_stepped:
-            samples = 0.5
-        
-        maya.utils.processIdleEvents()
-        qApp.processEvents()
-        
-        if len(to_bake) == 0:
-            pm.select(self.original_selection, r=True)
-            return
-        
-        # set key tangent to auto when baking
-        itt = pm.keyTangent(q=True, g=True, itt=True)
-        ott = pm.keyTangent(q=True, g=True, ott=True)
-        pm.keyTangent(g=True, itt='auto', ott='auto')
-        
-        # bake selected transforms and children with half step
-        pm.bakeResults(to_bake,
-                       time=time_range,
-                       sampleBy=samples,
-                       hierarchy='none',
-                       disableImplicitControl=True,
-                       preserveOutsideKeys=False,
-                       sparseAnimCurveBake=False,
-                       simulation=True,
-                       minimizeRotation=False,
-                       removeBakedAnimFromLayer=True)
-        
-        # set key tangent back to default
-        pm.keyTangent(g=True, itt=itt, ott=ott)
-        
-        pm.flushUndo()
-        # maya.utils.processIdleEvents()
-        # qApp.processEvents()
-        
-        # remove static channels to speed up analysis
-        # to_bake.extend(joints)
-        try:
-            pm.select(to_bake, r=True)
-            pm.delete(staticChannels=True)
-        except Exception as e:
-            sys.stdout.write(str(e) + '\n')
-        
-        muted_curves = []
-        
-        # progress bar
-        try:
-            gMainProgressBar = maya.mel.eval('$tmp = $gMainProgressBar')
-            pm.progressBar(gMainProgressBar,
-                           e=True,
-                           beginProgress=True,
-                           isInterruptable=True,
-                           status='Working...',
-                           maxValue=len(to_bake))
-        except Exception as e:
-            sys.stdout.write(str(e) + '\n')
-        
-        for obj in to_bake:
-            for curve in pm.keyframe(obj, q=True, name=True):
-                # find muted curves
-                connection = pm.listConnections(curve, d=True, s=False)[0]
-                if pm.nodeType(connection) == 'mute':
-                    if pm.getAttr('%s.mute' % connection):
-                        muted_curves.append(curve)
-                        continue
-                
-                # analyse half frames to determine which are stepped
-                if has_stepped:
-                    for key in range(int(time_range[0]), int(time_range[1])):
-                        try:
-                            epsilon_half = abs(pm.keyframe(curve, q=True, valueChange=True, time=(key,))[0]
-                                               - pm.keyframe(curve, q=True, valueChange=True, time=(key + 0.5,))[0])
-                            epsilon_full = abs(pm.keyframe(curve, q=True, valueChange=True, time=(key,))[0]
-                                               - pm.keyframe(curve, q=True, valueChange=True, time=(key + 1))[0])
-                            if epsilon_half < stepped_limit < epsilon_full:
-                                pm.keyTangent(curve, time=(key,), ott='step')
-                        except IndexError:
-                            continue
-            
-            # update progress
-            pm.progressBar(gMainProgressBar, e=True, step=1)
-            if pm.progressBar(gMainProgressBar, q=True, isCancelled=True):
-                break
-        
-        # end progressbar
-        pm.progressBar(gMainProgressBar, e=True, endProgress=True)
-        
-        qApp.processEvents()
-        
-        pm.delete(muted_curves)
-        
-        # remove unsnapped keys
-        if has_stepped:
-            pm.selectKey(to_bake, unsnappedKeys=True)
-            pm.cutKey(animation='keys', clear=True)
-        
-        # apply euler filter
-        if self.euler_filter_checkbox.isChecked():
-            self.apply_euler_filter(to_bake)
-        
-        pm.currentTime(time_range[0])
-        
-        # set a key on the first frame
-        # todo: when doing stepped animation, all rotations needs to be either stepped or not, because of the way unity interpolates
-        try:
-            if has_stepped:
-                tangent_type = 'step'
-            else:
-                tangent_type = 'auto'
-            
-            if to_bake:
-                pm.setKeyframe(to_bake, attribute=self.transform_attributes, t=time_range[0], insertBlend=False,
-                               ott=tangent_type)
-            if blendshapes:
-                pm.setKeyframe(blendshapes, t=time_range[0], insertBlend=False, ott=tangent_type)
-        except Exception as e:
-            sys.stdout.write(str(e) + '\n')
-        
-        # re-select original selection, so that we export the right thing
-        pm.select(self.original_selection, r=True)
-        
-        # select all child constraints if enabled
-        if self.constraints_checkbox.isChecked():
-            constraints = pm.listRelatives(pm.ls(sl=True), allDescendents=True, type='constraint')
-            pm.select(constraints, add=True)
-    
-    def remove_non_transform_curves(self):
-        objs = self.original_selection
-        objs.extend(pm.listRelatives(pm.ls(sl=True), allDescendents=True, type='transform'))
-        all_curves = set(pm.keyframe(objs, q=True, name=True))
-        transform_curves = set(pm.keyframe(objs, q=True, name=True, attribute=self.transform_attributes))
-        
-        for curve in all_curves:
-            if curve not in transform_curves:
-                pm.delete(curve)
-    
-    def apply_euler_filter(self, objs):
-        curves = pm.keyframe(objs, q=True, name=True, attribute=['rx', 'ry', 'rz'])
-        pm.filterCurve(curves, filter='euler')
-    
-    def export_fbx(self, time_range):
-        sys.stdout.write('# Preparing to write FBX file...\n')
-        
-        # maybe autokeyframe messes up something
-        autoKeyState = bool(pm.autoKeyframe(q=True, state=True))
-        pm.autoKeyframe(state=False)
-        
-        # set fbx options
-        try:
-            pm.mel.eval('FBXResetExport')  # reset any user preferences so we start clean
-            pm.mel.eval('FBXExportAnimationOnly -v %d' % int(self.animation_only_checkbox.isChecked()))
-            pm.mel.eval('FBXExportBakeComplexAnimation -v 0')
-            pm.mel.eval('FBXExportBakeComplexStart -v %d' % time_range[0])
-            pm.mel.eval('FBXExportBakeComplexEnd -v %d' % time_range[1])
-            pm.mel.eval('FBXExportBakeResampleAnimation -v 0')
-            pm.mel.eval('FBXExportCameras -v 1')
-            pm.mel.eval('FBXExportConstraints -v %d' % int(self.constraints_checkbox.isChecked()))
-            pm.mel.eval('FBXExportLights -v 1')
-            pm.mel.eval('FBXExportQuaternion -v quaternion')
-            pm.mel.eval('FBXExportAxisConversionMethod none')
-            pm.mel.eval('FBXExportApplyConstantKeyReducer -v 0')
-            pm.mel.eval('FBXExportSmoothMesh -v 0')  # do not export subdivision version
-            pm.mel.eval('FBXExportShapes -v 1')  # needed for skins and blend shapes
-            pm.mel.eval('FBXExportSkins -v 1')
-            pm.mel.eval('FBXExportSkeletonDefinitions -v 1')
-            pm.mel.eval('FBXExportEmbeddedTextures -v 0')
-            pm.mel.eval('FBXExportInputConnections -v %d' % int(self.input_connections_checkbox.isChecked()))
-            pm.mel.eval('FBXExportInstances -v 1')  # preserve instances by sharing same mesh
-            pm.mel.eval('FBXExportUseSceneName -v 1')
-            pm.mel.eval('FBXExportSplitAnimationIntoTakes -c')  # clear previous clips
-            pm.mel.eval('FBXExportFileVersion -v FBX201800')  # FBX version FBX202000 | FBX201900 | FBX201800 | FBX201600 | FBX201400 | FBX201300 | FBX201200 | FBX201100 | FBX201000 | FBX200900 | FBX200611
-            
-            if self.animation_clip_checkbox.isChecked():
-                for row in self.clip_data:
-                    pm.mel.eval('FBXExportSplitAnimationIntoTakes -v \"%s\" %f %f' %
-                                (str(row[0]), int(float(row[1])), int(float(row[2]))))
-            
-            pm.mel.eval('FBXExportGenerateLog -v 0')
-            pm.mel.eval('FBXExportInAscii -v 0')
-        except Exception as e:
-            sys.stdout.write(str(e) + '\n')
-        
-        # save the fbx
-        f = self.save_dir + '/' + self.file_name
-        
-        d = os.path.dirname(f)
-        if not os.path.isdir(d):
-            try:
-                os.makedirs(d)
-            except Exception as e:
-                sys.stdout.write(str(e) + '\n')
-                return
-        
-        # maya.utils.processIdleEvents()
-        
-        try:
-            pm.mel.eval('FBXExport -f "%s" -s' % f)
-        except Exception as e:
-            sys.stdout.write(str(e) + '\n')
-        
-        maya.utils.processIdleEvents()
-        
-        sys.stdout.write('# Saved fbx to: %s\n' % f)
-        pm.autoKeyframe(state=autoKeyState)
-    
     def close_window(self):
         self.close()
     
@@ -884,6 +833,15 @@ class ExportFbxToUnity(QMainWindow):
     def save_input_connections_option(self):
         pm.system.fileInfo['exportfbxtounity_input_connections'] = int(self.input_connections_checkbox.isChecked())
     
+    def save_skip_unchanged_option(self):
+        pm.system.fileInfo['exportfbxtounity_skip_unchanged'] = int(self.skip_unchanged_checkbox.isChecked())
+    
+    def save_export_report_option(self):
+        pm.system.fileInfo['exportfbxtounity_export_report'] = int(self.export_report_checkbox.isChecked())
+    
+    def save_export_sidecar_option(self):
+        pm.system.fileInfo['exportfbxtounity_export_sidecar'] = int(self.export_sidecar_checkbox.isChecked())
+    
     def save_constraints_option(self):
         pm.system.fileInfo['exportfbxtounity_constraints'] = int(self.constraints_checkbox.isChecked())
     
@@ -899,6 +857,15 @@ class ExportFbxToUnity(QMainWindow):
     def save_has_stepped_option(self):
         pm.system.fileInfo['exportfbxtounity_has_stepped'] = int(self.has_stepped_checkbox.isChecked())
     
+    def save_reduce_keys_option(self):
+        pm.system.fileInfo['exportfbxtounity_reduce_keys'] = int(self.reduce_keys_checkbox.isChecked())
+    
+    def save_context_bake_option(self):
+        pm.system.fileInfo['exportfbxtounity_context_bake'] = int(self.context_bake_checkbox.isChecked())
+    
+    def save_split_clips_option(self):
+        pm.system.fileInfo['exportfbxtounity_split_clips'] = int(self.split_clips_checkbox.isChecked())
+    
     def save_animation_clip_option(self):
         pm.system.fileInfo['exportfbxtounity_animation_clip'] = int(self.animation_clip_checkbox.isChecked())
     
@@ -950,6 +917,21 @@ class ExportFbxToUnity(QMainWindow):
         except (RuntimeError, KeyError):
             self.input_connections_checkbox.setChecked(False)
         
+        try:
+            self.skip_unchanged_checkbox.setChecked(int(pm.system.fileInfo['exportfbxtounity_skip_unchanged']))
+        except (RuntimeError, KeyError):
+            self.skip_unchanged_checkbox.setChecked(False)
+        
+        try:
+            self.export_report_checkbox.setChecked(int(pm.system.fileInfo['exportfbxtounity_export_report']))
+        except (RuntimeError, KeyError):
+            self.export_report_checkbox.setChecked(False)
+        
+        try:
+            self.export_sidecar_checkbox.setChecked(int(pm.system.fileInfo['exportfbxtounity_export_sidecar']))
+        except (RuntimeError, KeyError):
+            self.export_sidecar_checkbox.setChecked(False)
+        
         try:
             self.constraints_checkbox.setChecked(int(pm.system.fileInfo['exportfbxtounity_constraints']))
         except (RuntimeError, KeyError):
@@ -975,11 +957,26 @@ class ExportFbxToUnity(QMainWindow):
         except (RuntimeError, KeyError):
             self.has_stepped_checkbox.setChecked(False)
         
+        try:
+            self.reduce_keys_checkbox.setChecked(int(pm.system.fileInfo['exportfbxtounity_reduce_keys']))
+        except (RuntimeError, KeyError):
+            self.reduce_keys_checkbox.setChecked(False)
+        
+        try:
+            self.context_bake_checkbox.setChecked(int(pm.system.fileInfo['exportfbxtounity_context_bake']))
+        except (RuntimeError, KeyError):
+            self.context_bake_checkbox.setChecked(False)
+        
         try:
             self.animation_clip_checkbox.setChecked(int(pm.system.fileInfo['exportfbxtounity_animation_clip']))
         except (RuntimeError, KeyError):
             self.animation_clip_checkbox.setChecked(False)
         
+        try:
+            self.split_clips_checkbox.setChecked(int(pm.system.fileInfo['exportfbxtounity_split_clips']))
+        except (RuntimeError, KeyError):
+            self.split_clips_checkbox.setChecked(False)
+        
         # animation clips
         self.load_clips()
     
@@ -1007,9 +1004,1632 @@ class ExportFbxToUnity(QMainWindow):
         self.table_is_being_edited = False
 
 
-def apply_dpi_scaling(value):
-    if hasattr(cmds, 'mayaDpiSetting'):
-        scale = cmds.mayaDpiSetting(q=True, realScaleValue=True)
-        return int(scale * value)
-    else:
-        return int(value)
+class FbxExporter(object):
+    """
+    Bakes and exports FBX files without any user interface, so it can also be used in batch mode.
+    The options match the ones in the ExportFbxToUnity window.
+    """
+    
+    def __init__(self, save_dir=None, file_name=None, input_connections=False, constraints=False,
+                 animation_only=False, bake_animation=False, euler_filter=False, has_stepped=False, clips=None,
+                 skip_unchanged=False, reduce_keys=False, translate_tolerance=0.01, rotate_tolerance=0.05,
+                 weight_tolerance=0.001, export_report=False, fbx_preset=None, context_bake=False,
+                 export_sidecar=False):
+        self.save_dir = save_dir
+        self.file_name = file_name
+        self.input_connections = input_connections
+        self.constraints = constraints
+        self.animation_only = animation_only
+        self.bake_animation = bake_animation
+        self.euler_filter = euler_filter
+        self.has_stepped = has_stepped
+        self.clips = clips  # list of [name, start, end] or None
+        self.skip_unchanged = skip_unchanged
+        self.context_bake = context_bake  # sample with context_bake instead of bakeResults
+        
+        # max. difference from the baked animation when reducing keys, weight is used for all unitless channels
+        self.reduce_keys = reduce_keys
+        self.translate_tolerance = translate_tolerance
+        self.rotate_tolerance = rotate_tolerance  # degrees
+        self.weight_tolerance = weight_tolerance
+        
+        # time, counters and memory of each phase, written next to the fbx file if export_report is set
+        self.export_report = export_report
+        self.profiler = ExportProfiler()
+        
+        # clips, nodes, channels and hashes of each export, written next to the fbx file
+        self.export_sidecar = export_sidecar
+        
+        # path to a preset file saved with FbxExportPreset.save, otherwise the default fbx options are used
+        self.fbx_preset = fbx_preset
+        
+        self.original_selection = None
+        self.skipped = False  # last export was skipped because nothing changed
+        self.export_hash = None  # hash of the last export with skip_unchanged
+        self.transform_attributes = ['tx', 'ty', 'tz', 'rx', 'ry', 'rz', 'sx', 'sy', 'sz', 'visibility']
+    
+    def get_time_range(self):
+        if self.clips:
+            s = sorted(int(float(row[1])) for row in self.clips)
+            e = sorted(int(float(row[2])) for row in self.clips)
+            return s[0], e[-1]
+        return pm.playbackOptions(q=True, min=True), pm.playbackOptions(q=True, max=True)
+    
+    def get_options(self):
+        """
+        :return: Keyword arguments to create an exporter with the same options, e.g. for batch jobs
+        """
+        return dict(save_dir=self.save_dir,
+                    file_name=self.file_name,
+                    input_connections=self.input_connections,
+                    constraints=self.constraints,
+                    animation_only=self.animation_only,
+                    bake_animation=self.bake_animation,
+                    euler_filter=self.euler_filter,
+                    has_stepped=self.has_stepped,
+                    clips=self.clips,
+                    skip_unchanged=self.skip_unchanged,
+                    reduce_keys=self.reduce_keys,
+                    translate_tolerance=self.translate_tolerance,
+                    rotate_tolerance=self.rotate_tolerance,
+                    weight_tolerance=self.weight_tolerance,
+                    export_report=self.export_report,
+                    fbx_preset=self.fbx_preset,
+                    context_bake=self.context_bake,
+                    export_sidecar=self.export_sidecar)
+    
+    def get_clip_jobs(self, nodes, scene):
+        """
+        Create a batch job for each clip, exporting the clip as its own animation only file.
+        Files are named like MyCharacter@ClipName.fbx, using the part of the file name before any "@".
+        :param nodes: Nodes to export
+        :param scene: Scene file to export from
+        :return: List of jobs for batch_export
+        """
+        base = os.path.splitext(self.file_name)[0].split('@')[0]
+        nodes = cmds.ls([str(node) for node in nodes], long=True)
+        jobs = []
+        
+        for row in self.clips or []:
+            name = str(row[0]).replace('/', '_').replace('\\', '_')
+            start, end = int(float(row[1])), int(float(row[2]))
+            
+            job = self.get_options()
+            job.update(scene=scene,
+                       nodes=nodes,
+                       file_name='%s@%s.fbx' % (base, name),
+                       clips=[[row[0], start, end]],
+                       time_range=[start, end],
+                       animation_only=True)
+            jobs.append(job)
+        
+        return jobs
+    
+    def export_clips(self, nodes, scene, processes=None):
+        """
+        Export each clip as its own animation only file, in parallel headless mayapy processes.
+        With skip_unchanged, only clips that changed are exported again.
+        :param nodes: Nodes to export
+        :param scene: Scene file to export from, unsaved changes in the open scene are not exported
+        :param processes: Max. number of processes running at the same time
+        :return: List of (job, return code, log file) tuples
+        """
+        return batch_export(self.get_clip_jobs(nodes, scene), processes)
+    
+    def export(self, nodes, time_range=None, restore=False, save_hash=True):
+        """
+        Bake (if enabled) and export nodes without asking anything. Unless restore is set, baking changes the scene, so
+        it should not be saved afterwards.
+        :param nodes: Nodes to export
+        :param time_range: Tuple of start and end frame, defaults to the range of the clips or the time slider
+        :param restore: Undo the bake after exporting
+        :param save_hash: Write the export hash to the manifest, otherwise it is only kept in export_hash
+        :return: False if the export failed or was skipped because nothing changed
+        """
+        self.original_selection = pm.ls(nodes)
+        self.profiler = ExportProfiler()
+        self.skipped = False
+        self.export_hash = None
+        pm.select(self.original_selection, r=True)
+        
+        if time_range is None:
+            time_range = self.get_time_range()
+        
+        export_hash = None
+        if self.skip_unchanged:
+            self.profiler.start('export hash')
+            export_hash = self.get_export_hash(time_range)
+            self.profiler.stop()
+            if self.is_up_to_date(export_hash):
+                sys.stdout.write('# %s is up to date, skipped export\n' % self.get_export_path())
+                self.skipped = True
+                return False
+        
+        cycle_check = pm.cycleCheck(q=True, evaluation=True)
+        pm.cycleCheck(evaluation=False)
+        
+        try:
+            if self.bake_animation:
+                success = self.bake_and_export(time_range, restore)
+            else:
+                success = self.export_fbx(time_range)
+        finally:
+            pm.cycleCheck(evaluation=cycle_check)
+        
+        if success and export_hash is not None:
+            self.export_hash = export_hash
+            if save_hash:
+                self.save_export_hash(export_hash)
+        
+        return success
+    
+    def bake_and_export(self, time_range, restore=False):
+        """
+        Bake the animation, remove curves that should not be exported and export.
+        :param time_range: Tuple of start and end frame
+        :param restore: Bake inside an undo chunk and undo it after exporting, so the scene is left as it was without
+        having to save and re-open it
+        :return: True if the export succeeded
+        """
+        playback_range = pm.playbackOptions(q=True, min=True), pm.playbackOptions(q=True, max=True)
+        current_time = pm.currentTime(q=True)
+        undo_state = cmds.undoInfo(q=True, state=True)
+        
+        if restore:
+            cmds.undoInfo(state=True)
+            cmds.undoInfo(openChunk=True, chunkName='exportfbxtounity_bake')
+        
+        success = False
+        try:
+            # set playback range (appears that fbx uses it for the range when exporting)
+            pm.playbackOptions(min=time_range[0], max=time_range[1])
+            
+            try:
+                # bake keys
+                self.custom_bake(time_range, flush_undo=not restore)
+                
+                self.profiler.start('remove non transform curves')
+                self.remove_non_transform_curves()
+                self.profiler.stop()
+            except Exception as e:
+                sys.stdout.write(str(e) + '\n')
+            
+            try:
+                success = self.export_fbx(time_range)
+            except Exception as e:
+                sys.stdout.write(str(e) + '\n')
+        finally:
+            if restore:
+                cmds.undoInfo(closeChunk=True)
+                cmds.undo()
+                cmds.undoInfo(state=undo_state)
+                
+                # not part of the undo queue
+                pm.playbackOptions(min=playback_range[0], max=playback_range[1])
+                pm.currentTime(current_time)
+                sys.stdout.write('# Restored scene after baking\n')
+        
+        return success
+    
+    def custom_bake(self, time_range, flush_undo=True):
+        stepped_limit = 0.0001
+        
+        # get objects to bake
+        # baked_objects = list(self.original_selection)  # copy the list
+        # joints = pm.listRelatives(self.original_selection, allDescendents=True, type='joint')
+        # baked_objects.extend(pm.listRelatives(self.original_selection, allDescendents=True, type='transform'))
+        
+        # pm.select(baked_objects, r=True)
+        
+        # obj_list = om.MGlobal.getActiveSelectionList()
+        # iterator = om.MItSelectionList(obj_list, om.MFn.kDagNode)
+        self.profiler.start('find nodes')
+        try:
+            to_bake = pm.ls(self.original_selection, type='transform')
+            to_bake += pm.listRelatives(self.original_selection, allDescendents=True, type='transform')
+            
+            # create a set, and add all joints to the set
+            filtered = set(pm.ls(self.original_selection, type='joint'))
+            filtered |= set(pm.listRelatives(self.original_selection, allDescendents=True, type='joint'))  # union op.
+        except Exception as e:
+            sys.stdout.write("error 1: %s\n" % e)
+        
+        # add blendshapes and animated transforms to the set
+        blendshapes = set()
+        try:
+            blendshapes = set(find_blendshapes(to_bake))
+        except Exception as e:
+            pm.warning("Could not determine blendshape: %s" % e)
+        
+        # any inputs to transform attributes? i.e. any animation?
+        filtered |= set(self.find_animated_nodes(to_bake))
+        
+        to_bake = list(filtered.union(blendshapes))
+        self.profiler.stop(nodes=len(to_bake), blendshapes=len(blendshapes))
+        
+        samples = 1
+        has_stepped = self.has_stepped
+        if has_stepped:
+            samples = 0.5
+        
+        maya.utils.processIdleEvents()
+        process_qt_events()
+        
+        if len(to_bake) == 0:
+            pm.select(self.original_selection, r=True)
+            return
+        
+        # set key tangent to auto when baking
+        itt = pm.keyTangent(q=True, g=True, itt=True)
+        ott = pm.keyTangent(q=True, g=True, ott=True)
+        pm.keyTangent(g=True, itt='auto', ott='auto')
+        
+        def bake_results(nodes):
+            pm.bakeResults(nodes,
+                           time=time_range,
+                           sampleBy=samples,
+                           hierarchy='none',
+                           disableImplicitControl=True,
+                           preserveOutsideKeys=False,
+                           sparseAnimCurveBake=False,
+                           simulation=True,
+                           minimizeRotation=False,
+                           removeBakedAnimFromLayer=True)
+        
+        # bake selected transforms and children with half step
+        if self.context_bake:
+            # joints posed by ik handles have no input connections to sample, bake them afterwards with bakeResults,
+            # which also disables the handles
+            ik_joints = find_ik_joints(to_bake)
+            sampled = [node for node in to_bake if node not in ik_joints]
+            
+            self.profiler.start('context bake')
+            plugs = context_bake(sampled, time_range, samples)
+            self.profiler.stop(nodes=len(sampled), plugs=plugs, **count_curves_and_keys(sampled))
+            
+            if ik_joints:
+                self.profiler.start('bakeResults')
+                bake_results(ik_joints)
+                self.profiler.stop(nodes=len(ik_joints), **count_curves_and_keys(ik_joints))
+        else:
+            self.profiler.start('bakeResults')
+            bake_results(to_bake)
+            self.profiler.stop(nodes=len(to_bake), **count_curves_and_keys(to_bake))
+        
+        # set key tangent back to default
+        pm.keyTangent(g=True, itt=itt, ott=ott)
+        
+        if flush_undo:
+            pm.flushUndo()
+        # maya.utils.processIdleEvents()
+        # qApp.processEvents()
+        
+        # remove static channels to speed up analysis
+        # to_bake.extend(joints)
+        self.profiler.start('delete static channels')
+        try:
+            pm.select(to_bake, r=True)
+            pm.delete(staticChannels=True)
+        except Exception as e:
+            sys.stdout.write(str(e) + '\n')
+        self.profiler.stop(**count_curves_and_keys(to_bake))
+        
+        self.profiler.start('analyse curves')
+        analysed_curves = 0
+        muted_curves = []
+        
+        # progress bar
+        progress_bar = begin_progress(len(to_bake))
+        
+        for obj in to_bake:
+            for curve in pm.keyframe(obj, q=True, name=True):
+                analysed_curves += 1
+                
+                # find muted curves
+                connection = pm.listConnections(curve, d=True, s=False)[0]
+                if pm.nodeType(connection) == 'mute':
+                    if pm.getAttr('%s.mute' % connection):
+                        muted_curves.append(curve)
+                        continue
+                
+                # analyse half frames to determine which are stepped
+                if has_stepped:
+                    keys = cmds.keyframe(str(curve), q=True, timeChange=True, valueChange=True) or []
+                    stepped_frames = find_stepped_frames(keys[0::2], keys[1::2], time_range, stepped_limit)
+                    if stepped_frames:
+                        cmds.keyTangent(str(curve), time=[(t, t) for t in stepped_frames], ott='step')
+            
+            # update progress
+            if step_progress(progress_bar):
+                break
+        
+        # end progressbar
+        end_progress(progress_bar)
+        
+        process_qt_events()
+        
+        pm.delete(muted_curves)
+        
+        # remove unsnapped keys
+        if has_stepped:
+            pm.selectKey(to_bake, unsnappedKeys=True)
+            pm.cutKey(animation='keys', clear=True)
+        
+        self.profiler.stop(curves=analysed_curves, muted=len(muted_curves), stepped=has_stepped)
+        
+        # apply euler filter
+        if self.euler_filter:
+            self.profiler.start('euler filter')
+            curves = self.apply_euler_filter(to_bake)
+            self.profiler.stop(curves=len(curves or []))
+        
+        # reduce keys, after the euler filter so flips are not kept as motion
+        if self.reduce_keys and not has_stepped:
+            self.profiler.start('reduce keys')
+            removed = self.reduce_curves(to_bake)
+            self.profiler.stop(removed=removed, **count_curves_and_keys(to_bake))
+        
+        pm.currentTime(time_range[0])
+        
+        # set a key on the first frame
+        # todo: when doing stepped animation, all rotations needs to be either stepped or not, because of the way unity interpolates
+        try:
+            if has_stepped:
+                tangent_type = 'step'
+            else:
+                tangent_type = 'auto'
+            
+            if to_bake:
+                pm.setKeyframe(to_bake, attribute=self.transform_attributes, t=time_range[0], insertBlend=False,
+                               ott=tangent_type)
+            if blendshapes:
+                pm.setKeyframe(blendshapes, t=time_range[0], insertBlend=False, ott=tangent_type)
+        except Exception as e:
+            sys.stdout.write(str(e) + '\n')
+        
+        # re-select original selection, so that we export the right thing
+        pm.select(self.original_selection, r=True)
+        
+        # select all child constraints if enabled
+        if self.constraints:
+            constraints = pm.listRelatives(pm.ls(sl=True), allDescendents=True, type='constraint')
+            pm.select(constraints, add=True)
+    
+    def find_animated_nodes(self, nodes):
+        """
+        Find nodes with incoming connections on any of the transform attributes, using a single listConnections query
+        for all nodes.
+        :param nodes: Nodes to check
+        :return: List of animated nodes
+        """
+        if not nodes:
+            return []
+        
+        # connections are listed with long names, and may be on the parent, e.g. translate instead of translateX
+        attributes = set(self.transform_attributes)
+        for at in self.transform_attributes:
+            attributes.update(cmds.attributeQuery(at, type='transform', longName=True) or [])
+            attributes.update(cmds.attributeQuery(at, type='transform', listParent=True) or [])
+        
+        by_name = dict((str(node), node) for node in nodes)
+        connections = cmds.listConnections(list(by_name), source=True, destination=False, plugs=True,
+                                           connections=True) or []
+        
+        animated = {}
+        for plug in connections[0::2]:
+            name, at = plug.split('.', 1)
+            if at in attributes and name not in animated:
+                animated[name] = by_name.get(name) or pm.PyNode(name)
+        
+        return list(animated.values())
+    
+    def remove_non_transform_curves(self):
+        objs = list(self.original_selection)
+        objs.extend(pm.listRelatives(pm.ls(sl=True), allDescendents=True, type='transform'))
+        all_curves = set(pm.keyframe(objs, q=True, name=True))
+        transform_curves = set(pm.keyframe(objs, q=True, name=True, attribute=self.transform_attributes))
+        
+        for curve in all_curves:
+            if curve not in transform_curves:
+                pm.delete(curve)
+    
+    def reduce_curves(self, objs):
+        """
+        Remove baked keys that are not needed to reproduce the motion within the tolerance of each channel.
+        The reduced curves are evaluated at every baked key, and keys are added back where they are off by more than
+        the tolerance.
+        :param objs: Baked nodes
+        :return: Number of keys removed
+        """
+        tolerances = {'animCurveTL': self.translate_tolerance,
+                      'animCurveTA': self.rotate_tolerance,
+                      'animCurveTU': self.weight_tolerance}
+        
+        total_keys = 0
+        total_removed = 0
+        curves = cmds.keyframe([str(obj) for obj in objs], q=True, name=True) or []
+        
+        for curve in curves:
+            tolerance = tolerances.get(cmds.nodeType(curve))
+            keys = cmds.keyframe(curve, q=True, timeChange=True, valueChange=True) or []
+            times, values = keys[0::2], keys[1::2]
+            total_keys += len(times)
+            
+            if tolerance is None or len(times) < 3:
+                continue
+            
+            removed = [i for i, remove in enumerate(simplify_keys(times, values, tolerance)) if remove]
+            if not removed:
+                continue
+            
+            cmds.cutKey(curve, time=key_ranges(times, removed), option='keys', clear=True)
+            
+            # auto tangents do not interpolate linearly, add back keys where the curve is off too much. Added keys
+            # change the tangents of their neighbours, so check again until no removed key is off
+            selection = om.MSelectionList()
+            selection.add(curve)
+            fn = oma.MFnAnimCurve(selection.getDependNode(0))
+            
+            while removed:
+                off = [i for i in removed if abs(evaluate_curve(fn, times[i]) - values[i]) > tolerance]
+                if not off:
+                    break
+                
+                for i in off:
+                    cmds.setKeyframe(curve, time=times[i], value=values[i], itt='auto', ott='auto')
+                
+                off = set(off)
+                removed = [i for i in removed if i not in off]
+            
+            total_removed += len(removed)
+        
+        sys.stdout.write('# Reduced keys: %d of %d keys removed\n' % (total_removed, total_keys))
+        return total_removed
+    
+    def apply_euler_filter(self, objs):
+        """
+        Euler filter the rotation of the objects. Nodes with rx, ry and rz keyed at the same times are filtered together
+        with euler_filter and only the keys that changed are written back, other nodes use Maya's filterCurve.
+        :return: Filtered curves
+        """
+        groups = {}  # key times -> list of (curves, values, rotate order)
+        other_curves = []
+        all_curves = []
+        
+        for obj in objs:
+            obj = str(obj)
+            curves = []
+            for attr in ('rx', 'ry', 'rz'):
+                curves.extend(cmds.keyframe(obj, q=True, name=True, attribute=attr) or [])
+            all_curves.extend(curves)
+            
+            if len(curves) < 3:
+                other_curves.extend(curves)
+                continue
+            
+            keys = [cmds.keyframe(curve, q=True, timeChange=True, valueChange=True) or [] for curve in curves]
+            times = tuple(keys[0][0::2])
+            
+            if any(tuple(k[0::2]) != times for k in keys[1:]):
+                other_curves.extend(curves)
+                continue
+            
+            groups.setdefault(times, []).append((curves, [k[1::2] for k in keys], cmds.getAttr(obj + '.rotateOrder')))
+        
+        for times, nodes in groups.items():
+            # frames x nodes x channels
+            if np is not None:
+                rotations = np.array([values for curves, values, order in nodes], dtype=float).transpose(2, 0, 1)
+            else:
+                rotations = [[[values[c][f] for c in range(3)] for curves, values, order in nodes]
+                             for f in range(len(times))]
+            filtered = euler_filter(rotations, [order for curves, values, order in nodes])
+            
+            for n, (curves, values, order) in enumerate(nodes):
+                for c, curve in enumerate(curves):
+                    if np is not None:
+                        changed = np.flatnonzero(np.abs(filtered[:, n, c] - rotations[:, n, c]) > 1e-09).tolist()
+                    else:
+                        changed = [f for f in range(len(times)) if abs(filtered[f][n][c] - values[c][f]) > 1e-09]
+                    
+                    # one setAttr for each run of changed keys, undoable unlike editing the curve through the api
+                    for start, end in key_ranges(range(len(times)), changed):
+                        flat = []
+                        for f in range(start, end + 1):
+                            flat.extend((times[f], float(filtered[f][n][c])))
+                        cmds.setAttr('%s.ktv[%d:%d]' % (curve, start, end), *flat)
+        
+        if other_curves:
+            cmds.filterCurve(other_curves, filter='euler')
+        
+        return all_curves
+    
+    def export_fbx(self, time_range):
+        sys.stdout.write('# Preparing to write FBX file...\n')
+        
+        # maybe autokeyframe messes up something
+        autoKeyState = bool(pm.autoKeyframe(q=True, state=True))
+        pm.autoKeyframe(state=False)
+        
+        # reset and set all fbx options in one MEL call
+        self.profiler.start('fbx options')
+        try:
+            commands = self.get_fbx_preset(time_range).apply()
+        except Exception as e:
+            sys.stdout.write(str(e) + '\n')
+            commands = 0
+        self.profiler.stop(commands=commands)
+        
+        # save the fbx
+        f = self.get_export_path()
+        
+        d = os.path.dirname(f)
+        if not os.path.isdir(d):
+            try:
+                os.makedirs(d)
+            except Exception as e:
+                sys.stdout.write(str(e) + '\n')
+                pm.autoKeyframe(state=autoKeyState)
+                return False
+        
+        # maya.utils.processIdleEvents()
+        
+        success = True
+        self.profiler.start('FBXExport')
+        try:
+            pm.mel.eval('FBXExport -f "%s" -s' % f)
+        except Exception as e:
+            sys.stdout.write(str(e) + '\n')
+            success = False
+        
+        maya.utils.processIdleEvents()
+        self.profiler.stop(bytes=os.path.getsize(f) if os.path.isfile(f) else 0)
+        
+        sys.stdout.write('# Saved fbx to: %s\n' % f)
+        pm.autoKeyframe(state=autoKeyState)
+        
+        if success and self.export_sidecar:
+            self.profiler.start('sidecar')
+            self.write_sidecar(f, time_range)
+            self.profiler.stop()
+        
+        sys.stdout.write(self.profiler.summary())
+        if self.export_report:
+            self.profiler.write(os.path.splitext(f)[0] + '_export_report.json', fbx=f, scene=pm.system.sceneName(),
+                                time_range=list(time_range))
+        
+        return success
+    
+    def get_export_path(self):
+        return self.save_dir + '/' + self.file_name
+    
+    def get_sidecar(self, fbx_file, time_range):
+        """
+        Describe an exported file: the clips, nodes and animation channels with key counts and content hashes, so an
+        importer can find out which assets and clips changed without reading the fbx file.
+        Must be called on the scene as it was exported, i.e. after baking.
+        :return: Dictionary
+        """
+        roots = [str(node) for node in self.original_selection]
+        nodes = cmds.ls(roots, long=True) or []
+        nodes += cmds.listRelatives(roots, allDescendents=True, fullPath=True) or []
+        nodes = sorted(set(nodes))
+        
+        curves = sorted(set(cmds.keyframe(nodes, q=True, name=True) or []))
+        
+        channels = []
+        for curve in curves:
+            keys = cmds.keyframe(curve, q=True, timeChange=True, valueChange=True) or []
+            for plug in cmds.listConnections(curve, s=False, d=True, plugs=True, skipConversionNodes=True) or []:
+                channels.append({'plug': plug,
+                                 'keys': len(keys) // 2,
+                                 'hash': hash_values(keys)})
+        
+        clips = []
+        for row in self.clips or [['Take 001', time_range[0], time_range[1]]]:
+            start, end = float(row[1]), float(row[2])
+            values = []
+            for curve in curves:
+                # keys in the clip, and the values at the ends which depend on the keys around the clip
+                values.append(cmds.keyframe(curve, q=True, time=(start, end), timeChange=True, valueChange=True))
+                values.append(cmds.keyframe(curve, q=True, time=(start, start), eval=True, valueChange=True))
+                values.append(cmds.keyframe(curve, q=True, time=(end, end), eval=True, valueChange=True))
+            clips.append({'name': str(row[0]), 'start': start, 'end': end, 'hash': hash_values(values)})
+        
+        return {'version': SIDECAR_VERSION,
+                'fbx': os.path.basename(fbx_file),
+                'fbx_hash': hash_file(fbx_file),
+                'scene': pm.system.sceneName(),
+                'animation_only': bool(self.animation_only),
+                'time_range': [float(t) for t in time_range],
+                'clips': clips,
+                'nodes': nodes,
+                'channels': channels,
+                'hash': hash_values([channel['hash'] for channel in channels])}
+    
+    def write_sidecar(self, fbx_file, time_range):
+        path = os.path.splitext(fbx_file)[0] + SIDECAR_SUFFIX
+        
+        try:
+            sidecar = self.get_sidecar(fbx_file, time_range)
+            with open(path, 'w') as f:
+                json.dump(sidecar, f, separators=(',', ':'), sort_keys=True)
+            sys.stdout.write('# Saved sidecar to: %s\n' % path)
+        except (IOError, OSError, RuntimeError) as e:
+            sys.stdout.write(str(e) + '\n')
+    
+    def get_fbx_preset(self, time_range):
+        """
+        :return: FbxExportPreset with the fbx options for exporting the time range
+        """
+        if self.fbx_preset:
+            preset = FbxExportPreset.load(self.fbx_preset)
+        else:
+            preset = FbxExportPreset()
+        
+        preset.options.update(FBXExportAnimationOnly=bool(self.animation_only),
+                              FBXExportBakeComplexStart=int(time_range[0]),
+                              FBXExportBakeComplexEnd=int(time_range[1]),
+                              FBXExportConstraints=bool(self.constraints),
+                              FBXExportInputConnections=bool(self.input_connections))
+        preset.clips = [[str(row[0]), int(float(row[1])), int(float(row[2]))] for row in self.clips or []]
+        
+        return preset
+    
+    def get_export_hash(self, time_range):
+        """
+        Hash everything that ends up in the exported file: the options, time range and clips, the exported hierarchy
+        and the animation curves upstream of it. Must be called before baking.
+        :return: Hex digest
+        """
+        sha = hashlib.sha1()
+        
+        def add(*values):
+            sha.update(repr(values).encode('utf-8'))
+        
+        options = dict(input_connections=self.input_connections,
+                       constraints=self.constraints,
+                       animation_only=self.animation_only,
+                       bake_animation=self.bake_animation,
+                       euler_filter=self.euler_filter,
+                       has_stepped=self.has_stepped,
+                       reduce_keys=self.reduce_keys,
+                       context_bake=self.context_bake,
+                       tolerances=[self.translate_tolerance, self.rotate_tolerance, self.weight_tolerance],
+                       clips=self.clips,
+                       time_range=[float(t) for t in time_range],
+                       fbx_options=self.get_fbx_preset(time_range).options,
+                       manifest_version=MANIFEST_VERSION)
+        add(json.dumps(options, sort_keys=True))
+        
+        roots = [str(node) for node in self.original_selection]
+        nodes = cmds.ls(roots, long=True) or []
+        nodes += cmds.listRelatives(roots, allDescendents=True, fullPath=True) or []
+        nodes = sorted(set(nodes))
+        
+        for node in nodes:
+            node_type = cmds.nodeType(node)
+            add(node, node_type)
+            
+            if cmds.objectType(node, isAType='transform'):
+                add(cmds.xform(node, q=True, matrix=True))
+            elif node_type == 'mesh' and not self.animation_only:
+                add(hash_mesh(node))
+        
+        # animation curves driving the hierarchy, including the ones on rig controls and blendshapes
+        curves = sorted(set(cmds.ls(cmds.listHistory(nodes) or [], type='animCurve')))
+        
+        for curve in curves:
+            keys = {}
+            if cmds.nodeType(curve).startswith('animCurveT'):
+                # only keys affecting the time range, so a change in one clip does not export the other clips again
+                start = cmds.findKeyframe(curve, time=(time_range[0],), which='previous')
+                end = cmds.findKeyframe(curve, time=(time_range[1],), which='next')
+                keys['time'] = (min(start, time_range[0]), max(end, time_range[1]))
+            
+            add(curve,
+                cmds.keyframe(curve, q=True, timeChange=True, valueChange=True, **keys),
+                cmds.keyTangent(curve, q=True, inAngle=True, **keys),
+                cmds.keyTangent(curve, q=True, outAngle=True, **keys),
+                cmds.keyTangent(curve, q=True, inTangentType=True, **keys),
+                cmds.keyTangent(curve, q=True, outTangentType=True, **keys),
+                cmds.listConnections(curve, d=True, s=False, plugs=True))
+        
+        return sha.hexdigest()
+    
+    def get_manifest_path(self):
+        return os.path.join(self.save_dir, MANIFEST_NAME)
+    
+    def load_manifest(self):
+        try:
+            with open(self.get_manifest_path()) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+    
+    def is_up_to_date(self, export_hash):
+        """
+        :return: True if the fbx file exists and was exported with the same hash
+        """
+        if not os.path.isfile(self.get_export_path()):
+            return False
+        
+        entry = self.load_manifest().get(self.file_name)
+        return entry is not None and entry.get('hash') == export_hash
+    
+    def save_export_hash(self, export_hash):
+        update_manifest(self.save_dir, {self.file_name: {'hash': export_hash, 'scene': pm.system.sceneName()}})
+
+
+def update_manifest(save_dir, entries):
+    """
+    Add entries to the manifest of an export folder. The manifest is written to a temporary file first, so it is
+    never read half written. Batch workers do not call this, batch_export updates the manifest once they are done.
+    :param save_dir: Export folder
+    :param entries: Dictionary of file name -> {'hash': export hash, 'scene': scene}
+    """
+    path = os.path.join(save_dir, MANIFEST_NAME)
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+    except (IOError, OSError, ValueError):
+        manifest = {}
+    
+    manifest.update(entries)
+    
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f, indent=4, sort_keys=True)
+        
+        if hasattr(os, 'replace'):
+            os.replace(tmp_path, path)
+        else:
+            # python 2 can not rename onto an existing file on windows
+            if os.path.exists(path):
+                os.remove(path)
+            os.rename(tmp_path, path)
+    except (IOError, OSError) as e:
+        sys.stdout.write(str(e) + '\n')
+
+
+timer = getattr(time, 'perf_counter', time.time)
+
+
+def hash_values(values):
+    """
+    :return: Short content hash of a list of values, rounded so tiny float differences are ignored
+    """
+    def normalize(value):
+        if isinstance(value, float):
+            return round(value, 6)
+        if isinstance(value, (list, tuple)):
+            return [normalize(v) for v in value]
+        return value
+    
+    return hashlib.sha1(json.dumps(normalize(values)).encode('utf-8')).hexdigest()[:16]
+
+
+def hash_mesh(mesh):
+    """
+    Hash the mesh data written to the fbx file: points, polygons, uvs, material assignment, skin weights and
+    blendshape targets
+    :param mesh: Mesh shape
+    :return: Hex digest
+    """
+    sha = hashlib.sha1()
+    
+    def add(*values):
+        sha.update(repr(values).encode('utf-8'))
+    
+    def get_points(shape):
+        selection = om.MSelectionList()
+        selection.add(shape)
+        return [tuple(point) for point in om.MFnMesh(selection.getDagPath(0)).getPoints()]
+    
+    selection = om.MSelectionList()
+    selection.add(mesh)
+    path = selection.getDagPath(0)
+    fn = om.MFnMesh(path)
+    
+    add(get_points(mesh))
+    add(*[list(array) for array in fn.getVertices()])
+    
+    for uv_set in fn.getUVSetNames():
+        add(uv_set, *[list(array) for array in fn.getUVs(uv_set) + fn.getAssignedUVs(uv_set)])
+    
+    add(sorted(set(cmds.listConnections(mesh, type='shadingEngine') or [])))
+    
+    history = cmds.listHistory(mesh) or []
+    
+    for skin in cmds.ls(history, type='skinCluster'):
+        selection = om.MSelectionList()
+        selection.add(skin)
+        fn_skin = oma.MFnSkinCluster(selection.getDependNode(0))
+        
+        fn_component = om.MFnSingleIndexedComponent()
+        components = fn_component.create(om.MFn.kMeshVertComponent)
+        fn_component.setCompleteData(fn.numVertices)
+        
+        try:
+            weights = list(fn_skin.getWeights(path, components)[0])
+        except RuntimeError:
+            weights = None  # not deforming this mesh
+        add(skin, [influence.fullPathName() for influence in fn_skin.influenceObjects()], weights)
+    
+    # stored targets, or target meshes that are still connected
+    for blendshape in cmds.ls(history, type='blendShape'):
+        groups = '%s.inputTarget[0].inputTargetGroup' % blendshape
+        for group in cmds.getAttr(groups, multiIndices=True) or []:
+            items = '%s[%d].inputTargetItem' % (groups, group)
+            for item in cmds.getAttr(items, multiIndices=True) or []:
+                item = '%s[%d]' % (items, item)
+                targets = cmds.listConnections(item + '.inputGeomTarget', s=True, d=False, shapes=True)
+                if targets:
+                    add(item, get_points(targets[0]))
+                else:
+                    try:
+                        add(item, cmds.getAttr(item + '.inputPointsTarget'),
+                            cmds.getAttr(item + '.inputComponentsTarget'))
+                    except (RuntimeError, ValueError):
+                        add(item)  # no stored points
+    
+    return sha.hexdigest()
+
+
+def hash_file(path, block_size=1024 * 1024):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class FbxExportPreset(object):
+    """
+    A set of fbx export options, applied with a single MEL call.
+    """
+    
+    def __init__(self, options=None, name=None):
+        self.name = name
+        self.options = OrderedDict(DEFAULT_FBX_OPTIONS)
+        if options:
+            self.options.update(options)
+        self.clips = []  # list of [name, start, end]
+    
+    def get_commands(self):
+        """
+        :return: List of MEL commands
+        """
+        commands = ['FBXResetExport']  # reset any user preferences so we start clean
+        
+        for name, value in self.options.items():
+            if isinstance(value, bool):
+                value = int(value)
+            
+            if name == 'FBXExportAxisConversionMethod':
+                commands.append('%s %s' % (name, value))
+            else:
+                commands.append('%s -v %s' % (name, value))
+        
+        commands.append('FBXExportSplitAnimationIntoTakes -c')  # clear previous clips
+        for clip_name, start, end in self.clips:
+            commands.append('FBXExportSplitAnimationIntoTakes -v "%s" %f %f' % (clip_name, start, end))
+        
+        return commands
+    
+    def apply(self):
+        """
+        Reset the fbx options and apply all options. Options changed in Maya's FBX export dialog or by other tools
+        are never carried into the export.
+        :return: Number of MEL commands run
+        """
+        commands = self.get_commands()
+        pm.mel.eval(';\n'.join(commands) + ';')
+        return len(commands)
+    
+    def save(self, path):
+        """
+        Save the options as a named preset file, the clips are not saved
+        """
+        name = self.name or os.path.splitext(os.path.basename(path))[0]
+        with open(path, 'w') as f:
+            json.dump({'name': name, 'options': self.options}, f, indent=4)
+    
+    @classmethod
+    def load(cls, path):
+        """
+        Load a preset file, options missing from the file keep their default value
+        """
+        with open(path) as f:
+            data = json.load(f)
+        return cls(OrderedDict((str(k), v) for k, v in data.get('options', {}).items()), data.get('name'))
+
+
+class ExportProfiler(object):
+    """
+    Records wall time, counters and peak memory for each phase of an export
+    """
+    
+    def __init__(self):
+        self.phases = []
+        self.current = None
+        self.start_time = None
+    
+    def start(self, name):
+        self.current = {'name': name}
+        self.start_time = timer()
+    
+    def stop(self, **counters):
+        if self.current is None:
+            return
+        
+        self.current['seconds'] = timer() - self.start_time
+        self.current['peak_memory_mb'] = get_peak_memory()
+        self.current.update(counters)
+        self.phases.append(self.current)
+        self.current = None
+    
+    def summary(self):
+        lines = ['# Export profile:\n']
+        for phase in self.phases:
+            counters = ', '.join('%s=%s' % (k, v) for k, v in sorted(phase.items())
+                                 if k not in ('name', 'seconds', 'peak_memory_mb'))
+            lines.append('#   %-28s %8.2f s   %s\n' % (phase['name'], phase['seconds'], counters))
+        lines.append('#   %-28s %8.2f s   peak memory=%s MB\n' % ('total', sum(p['seconds'] for p in self.phases),
+                                                                   get_peak_memory()))
+        return ''.join(lines)
+    
+    def write(self, path, **info):
+        report = dict(info)
+        report['phases'] = self.phases
+        report['total_seconds'] = sum(p['seconds'] for p in self.phases)
+        report['date'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+        
+        try:
+            with open(path, 'w') as f:
+                json.dump(report, f, indent=4, sort_keys=True)
+            sys.stdout.write('# Saved export report to: %s\n' % path)
+        except (IOError, OSError) as e:
+            sys.stdout.write(str(e) + '\n')
+
+
+def get_peak_memory():
+    """
+    :return: Peak memory use of Maya in megabytes, or None if it could not be determined
+    """
+    try:
+        return round(cmds.memory(peakFootprint=True, megaByte=True), 1)
+    except (RuntimeError, TypeError):
+        pass
+    
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return round(peak / (1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0), 1)
+    except (ImportError, ValueError):
+        return None
+
+
+def count_curves_and_keys(nodes):
+    names = [str(node) for node in nodes]
+    if not names:
+        return {'curves': 0, 'keys': 0}
+    return {'curves': len(cmds.keyframe(names, q=True, name=True) or []),
+            'keys': cmds.keyframe(names, q=True, keyframeCount=True) or 0}
+
+
+def load_fbx_plugin():
+    if not pm.pluginInfo('fbxmaya', q=True, loaded=True):
+        try:
+            pm.loadPlugin('fbxmaya')
+        except:
+            pm.warning('# Could not load FBX plugin.')
+
+
+def get_mayapy():
+    name = 'mayapy.exe' if os.name == 'nt' else 'mayapy'
+    location = os.environ.get('MAYA_LOCATION')
+    
+    if location and os.path.isfile(os.path.join(location, 'bin', name)):
+        return os.path.join(location, 'bin', name)
+    
+    return name  # hope it is on the path
+
+
+def get_script_path():
+    return os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+
+
+def run_job(job, hash_file=None):
+    """
+    Open the scene of a job and export it. Used by the batch workers.
+    :param job: Dictionary with "scene", "nodes", optional "time_range" and FbxExporter options
+    :param hash_file: Write the export hash here instead of to the manifest, which is updated by batch_export
+    :return: EXIT_EXPORTED, EXIT_FAILED or EXIT_SKIPPED
+    """
+    job = dict(job)
+    scene = job.pop('scene')
+    nodes = job.pop('nodes')
+    time_range = job.pop('time_range', None)
+    
+    load_fbx_plugin()
+    pm.openFile(scene, force=True)
+    
+    exporter = FbxExporter(**job)
+    if exporter.export(nodes, time_range, save_hash=hash_file is None):
+        if hash_file and exporter.export_hash:
+            with open(hash_file, 'w') as f:
+                f.write(exporter.export_hash)
+        return EXIT_EXPORTED
+    elif exporter.skipped:
+        return EXIT_SKIPPED
+    return EXIT_FAILED
+
+
+def batch_export(jobs, processes=None, mayapy=None):
+    """
+    Export jobs in parallel, each job in its own headless mayapy process.
+    :param jobs: List of job dictionaries, see run_job
+    :param processes: Max. number of processes running at the same time, defaults to number of cpus
+    :param mayapy: Path to mayapy, defaults to the one of the running Maya
+    :return: List of (job, return code, log file) tuples
+    """
+    results = run_batch(jobs, processes, mayapy)
+    report_batch(results)
+    return results
+
+
+def run_batch(jobs, processes=None, mayapy=None):
+    """
+    Run the batch workers without writing anything to the Script Editor, so it can also be called from a thread.
+    The workers only write their export hash to a file, and the manifest of each export folder is updated once when
+    all workers are done.
+    :return: List of (job, return code, log file) tuples
+    """
+    mayapy = mayapy or get_mayapy()
+    processes = processes or multiprocessing.cpu_count()
+    job_dir = tempfile.mkdtemp(prefix='exportfbxtounity_')
+    
+    def run(args):
+        i, job = args
+        job_file = os.path.join(job_dir, 'job_%04d.json' % i)
+        log_file = os.path.join(job_dir, 'job_%04d.log' % i)
+        
+        with open(job_file, 'w') as f:
+            json.dump(job, f)
+        
+        with open(log_file, 'w') as log:
+            code = subprocess.call([mayapy, get_script_path(), '--worker', job_file], stdout=log,
+                                   stderr=subprocess.STDOUT)
+        
+        return job, code, log_file
+    
+    pool = ThreadPool(processes)
+    try:
+        results = pool.map(run, list(enumerate(jobs)))
+    finally:
+        pool.close()
+        pool.join()
+    
+    # save_dir -> {file name: manifest entry}
+    manifests = {}
+    for i, (job, code, log_file) in enumerate(results):
+        hash_file = os.path.join(job_dir, 'job_%04d.hash' % i)
+        if code != EXIT_EXPORTED or not os.path.isfile(hash_file):
+            continue
+        
+        with open(hash_file) as f:
+            entry = {'hash': f.read().strip(), 'scene': job.get('scene')}
+        manifests.setdefault(job.get('save_dir'), {})[job.get('file_name')] = entry
+    
+    for save_dir, entries in manifests.items():
+        update_manifest(save_dir, entries)
+    
+    return results
+
+
+def report_batch(results):
+    """
+    Write the result of each batch job to the Script Editor
+    :param results: List of (job, return code, log file) tuples from run_batch
+    """
+    failed = 0
+    for job, code, log_file in results:
+        if code == EXIT_EXPORTED:
+            sys.stdout.write('# Exported %s\n' % job.get('file_name'))
+        elif code == EXIT_SKIPPED:
+            sys.stdout.write('# Skipped %s, up to date\n' % job.get('file_name'))
+        else:
+            sys.stdout.write('# Failed to export %s, see %s\n' % (job.get('file_name'), log_file))
+            failed += 1
+    
+    sys.stdout.write('# Batch export done: %d of %d jobs failed\n' % (failed, len(results)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Export FBX files for Unity in parallel mayapy processes.')
+    parser.add_argument('jobs', help='JSON file with a list of jobs')
+    parser.add_argument('--processes', type=int, default=0, help='Number of processes, defaults to number of cpus')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)  # jobs is a single job
+    args = parser.parse_args(argv)
+    
+    with open(args.jobs) as f:
+        jobs = json.load(f)
+    
+    if args.worker:
+        try:
+            return run_job(jobs, os.path.splitext(args.jobs)[0] + '.hash')
+        except Exception:
+            traceback.print_exc()
+            return EXIT_FAILED
+    
+    results = batch_export(jobs, args.processes)
+    return int(any(code not in (EXIT_EXPORTED, EXIT_SKIPPED) for job, code, log_file in results))
+
+
+def find_blendshapes(nodes):
+    """
+    Find blendshapes deforming the shapes of the nodes, through any stack of deformers.
+    Walks upstream from each shape, without going into dag nodes (influences, targets), so stacked blendshapes like
+    facial and corrective shapes are all found. Nodes already walked from another shape are skipped.
+    :param nodes: Transform nodes
+    :return: List of blendShape nodes
+    """
+    shapes = cmds.listRelatives([str(node) for node in nodes], shapes=True, noIntermediate=True, fullPath=True)
+    if not shapes:
+        return []
+    
+    selection = om.MSelectionList()
+    for shape in shapes:
+        selection.add(shape)
+    
+    blendshapes = []
+    visited = set()
+    
+    for i in range(selection.length()):
+        root = selection.getDependNode(i)
+        it = om.MItDependencyGraph(root, om.MFn.kInvalid, om.MItDependencyGraph.kUpstream,
+                                   om.MItDependencyGraph.kDepthFirst, om.MItDependencyGraph.kNodeLevel)
+        
+        while not it.isDone():
+            node = it.currentNode()
+            
+            if node != root:
+                handle = om.MObjectHandle(node).hashCode()
+                
+                if handle in visited:
+                    it.prune()
+                else:
+                    visited.add(handle)
+                    
+                    # keep walking past blendshapes, the input geometry may be deformed by more of them
+                    if node.hasFn(om.MFn.kBlendShape):
+                        blendshapes.append(om.MFnDependencyNode(node).name())
+                    elif node.hasFn(om.MFn.kDagNode):
+                        it.prune()
+            
+            it.next()
+    
+    return pm.ls(blendshapes)
+
+
+def context_bake(nodes, time_range, sample_by=1.0):
+    """
+    Bake the driven keyable attributes of the nodes to new animation curves, without changing the current time.
+    Each plug is evaluated in a DG context for every sample, so only the graph upstream of the plugs is evaluated.
+    Unlike bakeResults with simulation, frames are not evaluated in order, so dynamics and expressions that depend on
+    the previous frame are not baked correctly. Joints posed by ik handles have no input connection and are skipped,
+    see find_ik_joints.
+    Curves are created with undoable commands, so the bake can be undone like bakeResults.
+    Attributes driven through their parent, e.g. decomposeMatrix.outputRotate -> rotate, are baked as well, and the
+    baked attributes are removed from animation layers, like removeBakedAnimFromLayer of bakeResults.
+    :param nodes: Nodes to bake
+    :param time_range: (start, end) in ui units
+    :param sample_by: Time between samples
+    :return: Number of plugs baked
+    """
+    names = []
+    plugs = []
+    for node in nodes:
+        node = str(node)
+        for attr in cmds.listAttr(node, keyable=True, scalar=True, multi=True) or []:
+            name = '%s.%s' % (node, attr)
+            try:
+                if cmds.getAttr(name, lock=True):
+                    continue
+                plug = om.MSelectionList().add(name).getPlug(0)
+            except (RuntimeError, ValueError):
+                continue
+            
+            # driven directly or through the parent, e.g. outputRotate -> rotate, like find_animated_nodes
+            if plug.isDestination or (plug.isChild and plug.parent().isDestination):
+                names.append(name)
+                plugs.append(plug)
+    
+    if not names:
+        return 0
+    
+    # time attributes are left alone
+    baked = [(name, plug, get_curve_type(plug)) for name, plug in zip(names, plugs)]
+    baked = [b for b in baked if b[2][0]]
+    if not baked:
+        return 0
+    names, plugs, curve_types = [[b[i] for b in baked] for i in range(3)]
+    
+    times = []
+    t = float(time_range[0])
+    while t <= time_range[1] + 1e-06:
+        times.append(t)
+        t = time_range[0] + len(times) * sample_by
+    
+    # sample everything before changing any connections
+    values = [[] for plug in plugs]
+    unit = om.MTime.uiUnit()
+    for t in times:
+        context = om.MDGContext(om.MTime(t, unit))
+        
+        if hasattr(context, 'makeCurrent'):  # Maya 2018 and later
+            previous = context.makeCurrent()
+            try:
+                for i, plug in enumerate(plugs):
+                    values[i].append(plug.asDouble())
+            finally:
+                previous.makeCurrent()
+        else:
+            for i, plug in enumerate(plugs):
+                values[i].append(plug.asDouble(context))
+    
+    # like removeBakedAnimFromLayer, the layers then connect the base animation directly
+    remove_from_anim_layers(plugs)
+    
+    # connections to parents of baked plugs, replaced by the baked children
+    parents = []
+    for name, plug in zip(names, plugs):
+        if plug.isChild and plug.parent().isDestination:
+            parent = '%s.%s' % (name.split('.', 1)[0], plug.parent().partialName(
+                includeNonMandatoryIndices=True, useFullAttributePath=True, useLongNames=True))
+            if parent not in parents:
+                parents.append(parent)
+    
+    for name in parents + names:
+        # replace the input, removing curves that no longer drive anything
+        for source in cmds.listConnections(name, s=True, d=False, plugs=True) or []:
+            cmds.disconnectAttr(source, name)
+            source_node = source.split('.')[0]
+            
+            if cmds.objectType(source_node, isAType='animCurve'):
+                if not cmds.listConnections(source_node, s=False, d=True):
+                    cmds.delete(source_node)
+    
+    for name, (curve_type, to_ui), plug_values in zip(names, curve_types, values):
+        # named like the curves of bakeResults, e.g. pCube1_translateX
+        curve_name = name.split('|')[-1]
+        for c in '.:[':
+            curve_name = curve_name.replace(c, '_')
+        curve = cmds.createNode(curve_type, name=curve_name.rstrip(']'), skipSelect=True)
+        
+        flat = []
+        for t, value in zip(times, plug_values):
+            flat.extend((t, to_ui(value)))
+        cmds.setAttr('%s.ktv[0:%d]' % (curve, len(times) - 1), *flat, size=len(times))
+        cmds.keyTangent(curve, itt='auto', ott='auto')
+        cmds.connectAttr(curve + '.output', name)
+    
+    return len(plugs)
+
+
+def find_ik_joints(nodes):
+    """
+    Find the nodes that are joints posed by ik handles. Their rotation is set by the handle without any input
+    connection, so context_bake can not sample them.
+    :param nodes: Nodes to bake
+    :return: List of the nodes in ik chains
+    """
+    joints = set()
+    for handle in cmds.ls(type='ikHandle'):
+        joints.update(cmds.ls(cmds.ikHandle(handle, q=True, jointList=True) or [], long=True))
+    
+    if not joints:
+        return []
+    
+    return [node for node in nodes if (cmds.ls(str(node), long=True) or [None])[0] in joints]
+
+
+def remove_from_anim_layers(plugs):
+    """
+    Remove plugs, or their parents, from every animation layer they are in. The animation of the base layer is
+    connected directly to the plugs afterwards.
+    :param plugs: List of MPlug
+    """
+    layers = cmds.ls(type='animLayer')
+    if not layers:
+        return
+    
+    wanted = set()
+    for plug in plugs:
+        wanted.add(plug.name())
+        if plug.isChild:
+            wanted.add(plug.parent().name())
+    
+    for layer in layers:
+        for attr in cmds.animLayer(layer, q=True, attribute=True) or []:
+            try:
+                name = om.MSelectionList().add(attr).getPlug(0).name()
+            except (RuntimeError, ValueError):
+                continue
+            
+            if name in wanted:
+                cmds.animLayer(layer, edit=True, removeAttribute=attr)
+
+
+def get_curve_type(plug):
+    """
+    :return: Tuple of (animation curve node type, function converting internal units to ui units) for a plug,
+             (None, None) for time attributes
+    """
+    attribute = plug.attribute()
+    
+    if attribute.hasFn(om.MFn.kUnitAttribute):
+        unit_type = om.MFnUnitAttribute(attribute).unitType()
+        
+        if unit_type == om.MFnUnitAttribute.kAngle:
+            unit = om.MAngle.uiUnit()
+            return 'animCurveTA', lambda value: om.MAngle(value).asUnits(unit)
+        elif unit_type == om.MFnUnitAttribute.kDistance:
+            unit = om.MDistance.uiUnit()
+            return 'animCurveTL', lambda value: om.MDistance(value).asUnits(unit)
+        elif unit_type == om.MFnUnitAttribute.kTime:
+            return None, None
+    
+    return 'animCurveTU', float
+
+
+def simplify_keys(times, values, tolerance):
+    """
+    Find keys that can be removed while a straight line between the remaining keys stays within tolerance
+    (Ramer-Douglas-Peucker). The first and last keys are always kept.
+    :param times: Key times
+    :param values: Key values
+    :param tolerance: Max. allowed value difference
+    :return: Removal mask with one boolean per key
+    """
+    count = len(values)
+    keep = [False] * count
+    
+    if count == 0:
+        return keep
+    
+    if np is not None:
+        times = np.asarray(times, dtype=float)
+        values = np.asarray(values, dtype=float)
+    
+    keep[0] = keep[-1] = True
+    segments = [(0, count - 1)]
+    
+    while segments:
+        first, last = segments.pop()
+        if last - first < 2:
+            continue
+        
+        slope = (values[last] - values[first]) / float(times[last] - times[first])
+        
+        if np is not None:
+            errors = np.abs(values[first + 1:last] - (values[first] + slope * (times[first + 1:last] - times[first])))
+            index = first + 1 + int(np.argmax(errors))
+            error = errors[index - first - 1]
+        else:
+            error, index = max((abs(values[i] - (values[first] + slope * (times[i] - times[first]))), i)
+                               for i in range(first + 1, last))
+        
+        if error > tolerance:
+            keep[index] = True
+            segments.append((first, index))
+            segments.append((index, last))
+    
+    return [not k for k in keep]
+
+
+def key_ranges(times, indices):
+    """
+    Merge runs of consecutive key indices into (start, end) time ranges
+    """
+    ranges = []
+    
+    for n, i in enumerate(indices):
+        if n == 0 or indices[n - 1] != i - 1:
+            ranges.append([times[i], times[i]])
+        else:
+            ranges[-1][1] = times[i]
+    
+    return [tuple(r) for r in ranges]
+
+
+def euler_filter(rotations, rotate_orders=0):
+    """
+    Remove euler flips from sampled rotations, like Maya's euler filter. Each frame uses the equivalent rotation closest
+    to the previous frame, with every channel unwrapped by whole turns. All nodes are filtered together.
+    Can be used on baked keys as well as sampled values before keys are created.
+    :param rotations: Rotations in degrees, as frames x 3 or frames x nodes x 3
+    :param rotate_orders: Rotate order of each node, as the rotateOrder attribute, or one for all nodes
+    :return: Filtered rotations, same shape as rotations
+    """
+    if np is None:
+        return _euler_filter_python(rotations, rotate_orders)
+    
+    rotations = np.array(rotations, dtype=float)
+    single = rotations.ndim == 2
+    if single:
+        rotations = rotations[:, np.newaxis, :]
+    
+    count = rotations.shape[1]
+    middle = np.zeros((count, 3), dtype=bool)
+    middle[np.arange(count), [ROTATE_ORDER_MIDDLE[int(o)] for o in np.broadcast_to(rotate_orders, (count,))]] = True
+    
+    # same rotation: 180 degrees added to the first and last axis, the middle axis mirrored
+    flipped = np.where(middle, 180.0 - rotations, rotations + 180.0)
+    
+    for f in range(1, len(rotations)):
+        previous = rotations[f - 1]
+        current = rotations[f] + 360.0 * np.round((previous - rotations[f]) / 360.0)
+        alternative = flipped[f] + 360.0 * np.round((previous - flipped[f]) / 360.0)
+        
+        use_alternative = np.abs(alternative - previous).sum(axis=1) < np.abs(current - previous).sum(axis=1)
+        rotations[f] = np.where(use_alternative[:, np.newaxis], alternative, current)
+    
+    if single:
+        return rotations[:, 0, :]
+    return rotations
+
+
+def _euler_filter_python(rotations, rotate_orders):
+    if not len(rotations):
+        return []
+    
+    single = not isinstance(rotations[0][0], (list, tuple))
+    if single:
+        rotations = [[frame] for frame in rotations]
+    rotations = [[list(r) for r in frame] for frame in rotations]
+    
+    count = len(rotations[0])
+    if not isinstance(rotate_orders, (list, tuple)):
+        rotate_orders = [rotate_orders] * count
+    
+    def unwrap(values, previous):
+        return [v + 360.0 * round((p - v) / 360.0) for v, p in zip(values, previous)]
+    
+    def distance(values, previous):
+        return sum(abs(v - p) for v, p in zip(values, previous))
+    
+    for f in range(1, len(rotations)):
+        for n in range(count):
+            previous = rotations[f - 1][n]
+            middle = ROTATE_ORDER_MIDDLE[int(rotate_orders[n])]
+            current = unwrap(rotations[f][n], previous)
+            alternative = unwrap([180.0 - v if c == middle else v + 180.0 for c, v in enumerate(rotations[f][n])],
+                                 previous)
+            
+            if distance(alternative, previous) < distance(current, previous):
+                rotations[f][n] = alternative
+            else:
+                rotations[f][n] = current
+    
+    if single:
+        return [frame[0] for frame in rotations]
+    return rotations
+
+
+def evaluate_curve(fn, time):
+    """
+    Evaluate an animation curve in ui units
+    :param fn: MFnAnimCurve
+    :param time: Time in ui units
+    """
+    value = fn.evaluate(om.MTime(time, om.MTime.uiUnit()))
+    
+    if fn.animCurveType == oma.MFnAnimCurve.kAnimCurveTA:
+        return om.MAngle(value).asUnits(om.MAngle.uiUnit())
+    elif fn.animCurveType == oma.MFnAnimCurve.kAnimCurveTL:
+        return om.MDistance(value).asUnits(om.MDistance.uiUnit())
+    
+    return value
+
+
+def find_stepped_frames(times, values, time_range, limit=0.0001):
+    """
+    Find whole frames of a curve baked on half frames, that hold their value until the next frame.
+    :param times: Key times
+    :param values: Key values
+    :param time_range: Tuple of start and end frame
+    :param limit: Max. difference for the value to be considered held
+    :return: List of frames where the out tangent should be stepped
+    """
+    start, end = int(time_range[0]), int(time_range[1])
+    
+    if np is not None:
+        # look up values by half frame index, frames without a key are nan and never match
+        half = np.rint(np.asarray(times, dtype=float) * 2).astype(int) - start * 2
+        inside = (half >= 0) & (half <= (end - start) * 2)
+        samples = np.full((end - start) * 2 + 1, np.nan)
+        samples[half[inside]] = np.asarray(values, dtype=float)[inside]
+        
+        frame = samples[0:-1:2]
+        epsilon_half = np.abs(frame - samples[1::2])
+        epsilon_full = np.abs(frame - samples[2::2])
+        
+        with np.errstate(invalid='ignore'):
+            stepped = (epsilon_half < limit) & (limit < epsilon_full)
+        
+        return (np.flatnonzero(stepped) + start).tolist()
+    
+    samples = dict((int(round(t * 2)), v) for t, v in zip(times, values))
+    stepped = []
+    
+    for key in range(start, end):
+        try:
+            epsilon_half = abs(samples[key * 2] - samples[key * 2 + 1])
+            epsilon_full = abs(samples[key * 2] - samples[key * 2 + 2])
+        except KeyError:
+            continue
+        
+        if epsilon_half < limit < epsilon_full:
+            stepped.append(key)
+    
+    return stepped
+
+
+def process_qt_events():
+    if not pm.about(batch=True):
+        qApp.processEvents()
+
+
+def begin_progress(max_value, status='Working...'):
+    """
+    Start Maya's main progress bar
+    :return: Name of the progress bar, or None in batch mode
+    """
+    if pm.about(batch=True):
+        return None
+    
+    try:
+        progress_bar = maya.mel.eval('$tmp = $gMainProgressBar')
+        pm.progressBar(progress_bar,
+                       e=True,
+                       beginProgress=True,
+                       isInterruptable=True,
+                       status=status,
+                       maxValue=max_value)
+        return progress_bar
+    except Exception as e:
+        sys.stdout.write(str(e) + '\n')
+        return None
+
+
+def step_progress(progress_bar):
+    """
+    Step the progress bar
+    :return: True if the user cancelled
+    """
+    if progress_bar is None:
+        return False
+    
+    pm.progressBar(progress_bar, e=True, step=1)
+    return pm.progressBar(progress_bar, q=True, isCancelled=True)
+
+
+def end_progress(progress_bar):
+    if progress_bar is not None:
+        pm.progressBar(progress_bar, e=True, endProgress=True)
+
+
+def apply_dpi_scaling(value):
+    if hasattr(cmds, 'mayaDpiSetting'):
+        scale = cmds.mayaDpiSetting(q=True, realScaleValue=True)
+        return int(scale * value)
+    else:
+        return int(value)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
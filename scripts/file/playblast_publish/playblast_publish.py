@@ -10,71 +10,104 @@
     the playblast file                      is copied to                        if a file exists, an archive is made before copying
     -------------------------------------------------------------------------------------------------------------------------------
     movies/playblasts/SH0010_ANI.mov        movies/SH0010/SH0010_ANI.mov        movies/SH0010/_archive/SH0010_ANI_v001.mov
-    movies/playblasts/SH0020_ANI.mov        movies/SH0020/SH0020_ANI.mov        movies/SH0020/_archive/SH0020_ANI_v001.mov  
+    movies/playblasts/SH0020_ANI.mov        movies/SH0020/SH0020_ANI.mov        movies/SH0020/_archive/SH0020_ANI_v001.mov
+
+### Performance
+    - Files are copied by several threads at the same time, see MAX_WORKERS.
+    - Copies are done inside the kernel when possible (copy_file_range or sendfile), which lets a NAS copy server side.
+    - The archived version is a hardlink to (or a rename of) the published file, not a second copy.
+    - A published file is only replaced when the new copy is complete.
+    - The size, mtime and content hash of each playblast file is stored in movies/.playblast_publish_manifest.json,
+      so only new or changed playblast files are examined. Playblast files that were saved again with the same size
+      are hashed, and not published again if the content is the same. Files with a new size are copied without
+      hashing them first.
+    - Use playblast_publish(rescan=True) to ignore the manifest, e.g. when published files were changed by hand.
 """
 
 import pymel.core as pm
-import glob
+import maya.mel
+import errno
+import hashlib
+import json
 import os
+import shutil
 import sys
 import re
-from shutil import copyfile
+import time
+from multiprocessing.pool import ThreadPool
+
+# number of files copied at the same time
+MAX_WORKERS = 4
+
+# bytes per kernel copy call
+COPY_CHUNK_SIZE = 64 * 1024 * 1024
 
-def playblast_publish():
+# size, mtime, content hash and last archived version of each playblast file, stored in the movie folder
+MANIFEST_NAME = '.playblast_publish_manifest.json'
+MANIFEST_VERSION = 1
+
+def playblast_publish(workers=MAX_WORKERS, rescan=False):
     answer = pm.confirmDialog(
-        title="Publish playblasted movies", 
-        message="Copy all files in playblasts folder to corresponding subfolders?", 
-        button=["OK", "Cancel"], 
-        defaultButton="OK", 
-        cancelButton="Cancel", 
+        title="Publish playblasted movies",
+        message="Copy all files in playblasts folder to corresponding subfolders?",
+        button=["OK", "Cancel"],
+        defaultButton="OK",
+        cancelButton="Cancel",
         dismissString="Cancel"
         )
 
     if answer == "Cancel":
         return
 
-    # move to movie folder in current maya project
+    # movie folder in current maya project
     movie_dir = pm.workspace(q=True, rootDirectory=True) + pm.workspace.fileRules['movie']
     movie_dir.replace('\\', '/')
     playblast_dir = movie_dir + "/playblasts"
 
-    os.chdir(playblast_dir)
-
-    # get all mov files in movie directory
-    source_files = []
-
-    for f in glob.glob("*.mov"):
-        source_files.append(f)
-        
-    source_files = sorted(source_files)
+    # entries from the last run, ignored when rescanning
+    manifest = {} if rescan else load_manifest(movie_dir)
+    new_manifest = {}
 
     # create subfolder based on file name
     prog = re.compile("([A-Za-z0-9])*")
-    errors = []
-    
-    for f in source_files:
+    jobs = []
+
+    for f, size, mtime in sorted(scan_movies(playblast_dir)):
+        entry = manifest.get(f)
+
+        # unchanged since the last run, nothing else to check
+        if entry is not None and entry.get('size') == size and entry.get('mtime') == mtime:
+            new_manifest[f] = entry
+            continue
+
         base = os.path.splitext(f)[0]
-        
-        # create folder for file
         result = prog.match(base)
         pub_dir = movie_dir + "/" + result.group(0)
-
-        if not os.path.exists(pub_dir):
-            os.makedirs(pub_dir)
-
         pub_file = ("%s/%s") % (pub_dir, f)
         playblast_file = ("%s/%s") % (playblast_dir, f)
 
-        is_newer = os.path.getmtime(playblast_file) > os.path.getmtime(pub_file)
+        try:
+            pub_mtime = os.path.getmtime(pub_file)
+        except OSError:
+            pub_mtime = None  # not published yet
+
+        # not in the manifest yet, publish if the playblast file is newer
+        if entry is None and pub_mtime is not None and mtime <= pub_mtime:
+            new_manifest[f] = {'size': size, 'mtime': mtime, 'hash': None, 'version': 0}
+            continue
+
+        # a different size means different content, only hash files that were saved again with the same size, so
+        # changed files are not read once more before the copy
+        check_content = entry is not None and entry.get('size') == size
+        entry = dict(entry or {'hash': None, 'version': 0}, size=size, mtime=mtime)
+        if not check_content:
+            entry['hash'] = None
+        new_manifest[f] = entry
 
-        # create version in _archive and playblast file is newer
-        if os.path.exists(pub_file) and is_newer:
-            archive_dir = pub_dir + "/_archive"
-            if not os.path.exists(archive_dir):
-                os.makedirs(archive_dir)
-                
-            version = 1
-            version_path = ""
+        # create version in _archive if a file is published already
+        version_path = None
+        if pub_mtime is not None:
+            version = entry['version'] + 1
 
             while (True):
                 version_path = ("%s/_archive/%s_v%03d.mov") % (pub_dir, base, version)
@@ -82,18 +115,16 @@ def playblast_publish():
                     break
                 version = version + 1
 
-            copyfile(pub_file, version_path)
+        jobs.append((playblast_file, pub_file, version_path, entry, check_content))
+
+    errors = publish_files(jobs, workers)
+
+    # failed files are examined again on the next run
+    for f in errors:
+        new_manifest.pop(os.path.basename(f), None)
+
+    save_manifest(movie_dir, new_manifest)
 
-        # copy from movie_dir to subfolder if newer
-        
-        if is_newer:
-            try:
-                copyfile(playblast_file, pub_file)
-            except:
-                errors.append(pub_file)
-            print("# Copied %s" % (playblast_file))
-            print("# --> %s" % (pub_file))
-        
     if errors:
         print('\n\n# Failed to copy to the following files:')
         for error in errors:
@@ -103,4 +134,227 @@ def playblast_publish():
         sys.stdout.write('\n\n# Successfully copied all files!\n')
 
 
+def scan_movies(directory):
+    """
+    List the .mov files in a directory with a single directory read.
+    :return: List of (file name, size, mtime)
+    """
+    movies = []
+
+    if hasattr(os, 'scandir'):
+        for entry in os.scandir(directory):
+            if entry.name.endswith('.mov') and entry.is_file():
+                stat = entry.stat()
+                movies.append((entry.name, stat.st_size, stat.st_mtime))
+    else:
+        for name in os.listdir(directory):
+            if name.endswith('.mov'):
+                path = os.path.join(directory, name)
+                if os.path.isfile(path):
+                    stat = os.stat(path)
+                    movies.append((name, stat.st_size, stat.st_mtime))
+
+    return movies
+
+
+def get_manifest_path(movie_dir):
+    return os.path.join(movie_dir, MANIFEST_NAME)
+
+
+def load_manifest(movie_dir):
+    try:
+        with open(get_manifest_path(movie_dir)) as f:
+            manifest = json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+    if manifest.get('manifest_version') != MANIFEST_VERSION:
+        return {}
+
+    return manifest.get('files', {})
+
+
+def save_manifest(movie_dir, files):
+    path = get_manifest_path(movie_dir)
+    tmp_path = path + '.tmp'
+
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump({'manifest_version': MANIFEST_VERSION, 'files': files}, f, indent=1, sort_keys=True)
+        replace_file(tmp_path, path)
+    except (IOError, OSError) as e:
+        sys.stdout.write('# Could not save publish manifest: %s\n' % e)
+
+
+def publish_files(jobs, workers=MAX_WORKERS):
+    """
+    Publish files in parallel, showing the progress in Maya's progress bar
+    :param jobs: List of (playblast file, published file, archive file or None, manifest entry, check content)
+    :param workers: Number of files copied at the same time
+    :return: List of published files that failed
+    """
+    if not jobs:
+        return []
+
+    total_bytes = sum(job[3]['size'] for job in jobs)
+    done_bytes = 0
+    copied_bytes = 0
+    copied = 0
+    errors = []
+    start_time = time.time()
+
+    progress_bar = maya.mel.eval('$tmp = $gMainProgressBar')
+    pm.progressBar(progress_bar, edit=True, beginProgress=True, isInterruptable=False,
+                   status='Publishing %d files...' % len(jobs), maxValue=max(total_bytes // (1024 * 1024), 1))
+
+    pool = ThreadPool(max(1, min(workers, len(jobs))))
+    try:
+        for job, size, error in pool.imap_unordered(publish_file, jobs):
+            playblast_file, pub_file, version_path, entry, check_content = job
+            done_bytes += entry['size']
+
+            if error is not None:
+                sys.stdout.write('# %s: %s\n' % (pub_file, error))
+                errors.append(pub_file)
+            elif size is None:
+                print("# Unchanged %s" % (playblast_file))
+            else:
+                copied += 1
+                copied_bytes += size
+                if version_path:
+                    print("# Archived %s" % (version_path))
+                print("# Copied %s" % (playblast_file))
+                print("# --> %s" % (pub_file))
+
+            pm.progressBar(progress_bar, edit=True, progress=done_bytes // (1024 * 1024),
+                           status='Published %.0f of %.0f MB' % (done_bytes / 1048576.0, total_bytes / 1048576.0))
+    finally:
+        pool.close()
+        pool.join()
+        pm.progressBar(progress_bar, edit=True, endProgress=True)
+
+    seconds = max(time.time() - start_time, 0.001)
+    sys.stdout.write('# Published %d files, %.1f MB in %.1f s (%.1f MB/s)\n' % (
+        copied, copied_bytes / 1048576.0, seconds, copied_bytes / 1048576.0 / seconds))
+
+    return errors
+
+
+def publish_file(job):
+    """
+    Copy a playblast file next to the published file, archive the published file and then replace it.
+    With check content, the file is hashed first and not copied if it has the same hash as when it was last
+    published. Otherwise the file is copied without reading it here, and the hash is stored as None.
+    The manifest entry is updated with the new hash and archive version.
+    Runs in a worker thread.
+    :param job: (playblast file, published file, archive file or None, manifest entry, check content)
+    :return: Tuple of (job, bytes copied or None if unchanged, error or None)
+    """
+    playblast_file, pub_file, version_path, entry, check_content = job
+    tmp_file = pub_file + '.tmp'
+
+    try:
+        content_hash = None
+        if check_content:
+            content_hash = hash_file(playblast_file)
+
+            # only touched, e.g. playblasted again without changes
+            if version_path and content_hash == entry['hash']:
+                return job, None, None
+
+        make_dirs(os.path.dirname(version_path or pub_file))
+        size = copy_file(playblast_file, tmp_file)
+
+        if version_path:
+            archive_file(pub_file, version_path)
+            entry['version'] = int(re.search(r'_v(\d+)\.mov$', version_path).group(1))
+
+        replace_file(tmp_file, pub_file)
+        entry['hash'] = content_hash
+        return job, size, None
+    except (IOError, OSError) as e:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        return job, 0, e
+
+
+def hash_file(path, block_size=1024 * 1024):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def make_dirs(path):
+    # several threads may create the same folder
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def copy_file(src, dst):
+    """
+    Copy a file inside the kernel when possible, with copy_file_range (Linux, Python 3.8+) or sendfile (Linux and
+    Python 3), so the data does not pass through Python and a NAS may copy it server side.
+    Falls back to shutil.copyfile.
+    :return: Number of bytes copied
+    """
+    size = os.path.getsize(src)
+
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        for name in ('copy_file_range', 'sendfile'):
+            if not hasattr(os, name) or not sys.platform.startswith('linux'):
+                continue
+
+            offset = 0
+            try:
+                while offset < size:
+                    count = min(COPY_CHUNK_SIZE, size - offset)
+                    if name == 'copy_file_range':
+                        sent = os.copy_file_range(fsrc.fileno(), fdst.fileno(), count, offset, offset)
+                    else:
+                        sent = os.sendfile(fdst.fileno(), fsrc.fileno(), offset, count)
+
+                    if sent == 0:
+                        break
+                    offset += sent
+            except OSError as e:
+                # not supported between these file systems, try the next method
+                if offset or e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP,
+                                             errno.EPERM):
+                    raise
+
+            if offset == size:
+                return size
+
+            fdst.seek(0)
+            fdst.truncate()
+
+    shutil.copyfile(src, dst)
+    return size
+
+
+def archive_file(pub_file, version_path):
+    """
+    Keep the published file as an archived version, without copying it
+    """
+    try:
+        os.link(pub_file, version_path)  # the published file is replaced afterwards, the link keeps the old data
+    except (AttributeError, OSError):
+        os.rename(pub_file, version_path)  # no hardlinks on this file system
+
+
+def replace_file(src, dst):
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+    else:
+        # Python 2 can not rename onto an existing file on Windows
+        if os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+
 playblast_publish()